@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
+import json
 import operator
 import optparse
 import os
 import sys
 import time
 
-from awstats_reader import (AwstatsReader as ar, AwstatsDateTime, AwstatsDate,
-                            make_get_field)
+from awstats_reader import (AwstatsMonth, cache_files, month_data, merge_data,
+                            sort_section, write_cache_file, set_total_unique,
+                            save_unique_sketch)
 from odict import OrderedDict as od
 
 ap = os.path.abspath
@@ -32,11 +34,43 @@ def get_opts():
       'specified, domain1 and domain2 must be different',)
     a('--outdomain', dest='outdomain', default=None, help='Domain name for output files.')
     a('--outdir', dest='outdir', default=None, help='Directory for output files')
+    a('--watch', dest='watch', action='store_true', default=False,
+      help='Keep running, re-merging a month whenever one of its source files changes')
+    a('--interval', dest='interval', type='float', default=60.0,
+      help='Seconds between polls of the source files in watch mode. Default: %default')
+    a('--source', dest='sources', action='append', default=[], metavar='DIR:DOMAIN',
+      help='A further directory and domain to merge in. May be given more than once')
+    a('--manifest', dest='manifest', default=None, metavar='FILE',
+      help='Write a manifest of the months to merge to FILE, instead of merging them')
+    a('--worker', dest='worker', default=None, metavar='FILE',
+      help='Merge the months of the manifest FILE belonging to --shard, into a '
+      'staging directory under the manifest\'s outdir')
+    a('--shard', dest='shard', default='0/1', metavar='I/N',
+      help='With --worker, merge every Nth month of the manifest, starting at '
+      'the Ith (counting from 0). Default: %default')
+    a('--reduce', dest='reduce', default=None, metavar='FILE',
+      help='Check that every month of the manifest FILE has been merged by a '
+      'worker, and if so move them all into the outdir')
 
 
     # Some sanity checking
     (opts, args) = parser.parse_args()
 
+    if opts.worker or opts.reduce:
+        # Everything else comes from the manifest
+        try:
+            shard, shards = [int(x) for x in opts.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be of the form I/N')
+        if not 0 <= shard < shards:
+            parser.error('--shard must be of the form I/N, with 0 <= I < N')
+        opts.shard = (shard, shards)
+        return (opts, args)
+
+    for source in opts.sources:
+        if ':' not in source:
+            parser.error('--source must be of the form DIR:DOMAIN')
+
     if opts.outdir is None:
         parser.error('Outdomain and Outdir must be specified')
 
@@ -56,41 +90,19 @@ def get_opts():
     if opts.outdomain is None:
         opts.outdomain = opts.domain1
 
-    if opts.outdomain == opts.domain1 and ap(opts.outdir) == ap(opts.dir1):
-        parser.error('Domain1 and outdomain cannot be the same when outdir and dir1 are the same')
-
-    if opts.outdomain == opts.domain2 and ap(opts.outdir) == ap(opts.dir2):
-        parser.error('Domain1 and outdomain cannot be the same when outdir and dir1 are the same')
+    # Otherwise the output would be merged back into itself
+    for directory, domain in get_sources(opts):
+        if opts.outdomain == domain and ap(opts.outdir) == ap(directory):
+            parser.error('A source cannot be the same as outdir and outdomain: %s:%s'
+                         % (directory, domain))
 
     return (opts, args)
 
 def write_file(dest_dir, domain, year, month, data, version):
     month = '%02d' % month
     out_file_name = os.path.join(dest_dir, 'awstats' + month + str(year) + '.' + domain + '.txt')
-
-    outfile = open(out_file_name, 'w')
-
-    outfile.write('AWSTATS DATA FILE %s (build %s)\n\n' % version)
-
-    for section in data.keys():
-        outfile.write('BEGIN_' + section.upper() + ' ' + str(len(data[section])) + '\n')
-        for row in data[section]:
-            row_data = []
-            row_data.append(row) # The row name/key
-            for field in data[section][row]:
-                v = data[section][row][field]
-                if isinstance(v, AwstatsDateTime):
-                    row_data.append(v.strftime('%Y%m%d%H%M%S'))
-                elif isinstance(v, AwstatsDate):
-                    row_data.append(v.strftime('%Y%m%d'))
-                else:
-                    row_data.append(v)
-            outfile.write(' '.join([str(x) for x in row_data]) + '\n')
-
-        outfile.write('END_' + section.upper() + '\n')
-        outfile.write('\n')
-
-    outfile.close()
+    write_cache_file(out_file_name, data, version)
+    return out_file_name
 
 def merge_month(m1, m2):
     """
@@ -102,84 +114,245 @@ def merge_month(m1, m2):
     sections.update(od([(k, True) for k in m2.keys()]))
 
     for section in sections:
-        data[section] = od()
-
         s1 = m1[section]
         s2 = m2[section]
 
-        rows = od([(k, True) for k in s1.keys()])
-        rows.update(od([(k, True) for k in s2.keys()]))
-        for row_name in rows:
-            d1 = s1.get(row_name)
-            d2 = s2.get(row_name)
-
-            if d1 is None or d2 is None:
-                data[section][row_name] = d1 or d2
-                continue
-            else:
-                data[section][row_name] = od()
-
-            # Some rows have optional fields.
-            if len(d1) >= len(d2):
-                field_list = d1.keys()
-            else:
-                field_list = d2.keys()
-
-            for field in field_list:
-                data[section][row_name][field] = od()
-                # Again, those options fields
-                if field not in d1:
-                    data[section][row_name][field] = d2[field]
-                    continue
-                elif field not in d2:
-                    data[section][row_name][field] = d1[field]
-                    continue
-                data[section][row_name][field] = s1.merge(s2, row_name, field)
-
-        sort_num, sort_by, sort_reversed = s1.get_sort_info()
-        if sort_num:
-            if sort_by == 'key':
-                data[section] = od(sorted(data[section].iteritems()))
-            elif sort_by == 'key_int':
-                data[section] = od(sorted(data[section].iteritems(), key=lambda x: int(x[0])))
-            else:
-                data[section] = od(sorted(data[section].iteritems(), key=awmake_get_field(sort_by), reverse=sort_reversed))
+        data[section] = sort_section(section, s1.merge_section(s2))
 
+    set_total_unique(data)
     return data
 
+def get_sources(opts):
+    """
+    Returns the list of (directory, domain) to merge
+    """
+    sources = [(opts.dir1, opts.domain1), (opts.dir2, opts.domain2)]
+    for source in opts.sources:
+        directory, domain = source.rsplit(':', 1)
+        sources.append((directory, domain))
+    return sources
 
-def main():
+def find_units(sources):
     """
-    Get all the years and months, cycles through them, calling merge_month
+    Finds the cache files of each (directory, domain) in sources, and returns
+    a list of (year, month, [file names]) units of work: one per month, with
+    that month's files in the order of sources.
+    """
+    units = {}
+    for directory, domain in sources:
+        for key, fname in cache_files(directory, domain).items():
+            units.setdefault(key, []).append(fname)
+    return [(year, month, units[(year, month)]) for year, month in sorted(units)]
+
+def merge_unit(dest_dir, domain, year, month, fnames):
+    """
+    Merges (or copies, if there is only one) a month's cache files and writes
+    the result, along with its unique visitor sketch, to dest_dir. Returns
+    the name of the file written.
+    """
+    months = [AwstatsMonth(year, month, fname) for fname in fnames]
+    if len(months) == 1:
+        data = month_data(months[0])
+    else:
+        data = merge_month(months[0], months[1])
+        for m in months[2:]:
+            data = merge_data(data, month_data(m))
+        set_total_unique(data)
+
+    version = max([m.version for m in months])
+    sketch = months[0].unique_sketch()
+    for m in months[1:]:
+        sketch.merge(m.unique_sketch())
+
+    out_file_name = write_file(dest_dir, domain, year, month, data, version)
+    save_unique_sketch(out_file_name, sketch)
+    return out_file_name
+
+def merge_all(opts):
+    """
+    Get all the years and months, cycles through them, calling merge_unit
     to do the main part of the work.
     """
-    (opts, args) = get_opts()
+    for year, month, fnames in find_units(get_sources(opts)):
+        merge_unit(opts.outdir, opts.outdomain, year, month, fnames)
 
-    # TODO: Need to get a version string
-    dom1 = ar(opts.dir1, opts.domain1)
-    dom2 = ar(opts.dir2, opts.domain2)
+def poll_sources(sources, state):
+    """
+    Checks the cache files of each (directory, domain) in sources against
+    the state left by the previous poll, and returns the set of (year, month)
+    whose data has changed. A file is only re-read when its size or mtime
+    has changed, and only counts as changed when general.LastUpdate differs
+    as well. Files which can't be read are reported on stderr and left out of
+    the state, so they are tried again on the next poll.
+    """
+    changed = set()
+    for directory, domain in sources:
+        for (year, month), fname in cache_files(directory, domain).items():
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue # Removed between the glob and the stat
+            sig = (st.st_size, st.st_mtime)
+            prev_sig, prev_update = state.get(fname, (None, None))
+            if sig == prev_sig:
+                continue
 
-    years = set(dom1.years).union(dom2.years)
+            try:
+                last_update = AwstatsMonth(year, month, fname)['general'].get('LastUpdate')
+            except (IOError, IndexError, KeyError, ValueError), e:
+                print >> sys.stderr, 'Cannot read %s: %s' % (fname, e)
+                continue
+            state[fname] = (sig, last_update)
+            if prev_sig is None or last_update != prev_update:
+                changed.add((year, month))
 
-    for year in years:
-        months = set()
-        if year in dom1:
-            months = months.union(dom1[year].months)
-        if year in dom2:
-            months= months.union(dom1[year].months)
+    return changed
 
-        for  month in months:
-            if year not in dom1 or month not in dom1[year]:
-                write_file(opts.outdir, opts.outdomain, year, month, dom2)
-                continue
-            if year not in dom2 or month not in dom2[year]:
-                write_file(opts.outdir, opts.outdomain, year, month, dom1)
+def merge_changed(opts, sources, state):
+    """
+    Polls the source files once, and re-merges the months which changed. A
+    month which fails to merge is reported on stderr, and its files are
+    dropped from the state so it is tried again on the next poll. Returns
+    the list of (year, month) which failed.
+    """
+    failed = []
+    changed = poll_sources(sources, state)
+    if not changed:
+        return failed
+
+    for year, month, fnames in find_units(sources):
+        if (year, month) not in changed:
+            continue
+        if opts.verbose:
+            print 'Merging %s-%02d' % (year, month)
+        try:
+            merge_unit(opts.outdir, opts.outdomain, year, month, fnames)
+        except Exception, e:
+            # Keep watching the other months
+            print >> sys.stderr, 'Merging %s-%02d failed: %s' % (year, month, e)
+            for fname in fnames:
+                state.pop(fname, None)
+            failed.append((year, month))
+    return failed
+
+def watch(opts):
+    """
+    Polls the source files forever, re-merging only the months which changed
+    """
+    sources = get_sources(opts)
+    state = {}
+    while True:
+        merge_changed(opts, sources, state)
+        time.sleep(opts.interval)
+
+def staging_dir(manifest):
+    return os.path.join(manifest['outdir'], '.awstats_merge_staging')
+
+def write_manifest(fname, opts):
+    """
+    Writes a manifest of the months to merge, for workers (possibly on other
+    machines sharing the same storage) to process
+    """
+    manifest = {'outdir':ap(opts.outdir), 'outdomain':opts.outdomain,
+                'units':[{'year':year, 'month':month, 'sources':[ap(f) for f in fnames]}
+                         for year, month, fnames in find_units(get_sources(opts))]}
+    f = open(fname, 'w')
+    json.dump(manifest, f, indent=1)
+    f.close()
+    return manifest
+
+def read_manifest(fname):
+    f = open(fname)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def run_worker(manifest, shard, shards, verbose=False):
+    """
+    Merges every shards'th unit of the manifest, starting at shard, into the
+    staging directory. Returns the list of files written.
+    """
+    dest_dir = staging_dir(manifest)
+    try:
+        os.makedirs(dest_dir)
+    except OSError:
+        if not os.path.isdir(dest_dir): # Another worker may have made it
+            raise
+
+    written = []
+    for index, unit in enumerate(manifest['units']):
+        if index % shards != shard:
+            continue
+        if verbose:
+            print 'Merging %s-%02d' % (unit['year'], unit['month'])
+        written.append(merge_unit(dest_dir, manifest['outdomain'], unit['year'],
+                                  unit['month'], unit['sources']))
+    return written
+
+def run_reduce(manifest):
+    """
+    Checks that every unit of the manifest has been merged into the staging
+    directory, and is no older than its sources. If they all have, they are
+    moved into the outdir. Returns a list of problems found; if there are
+    any, nothing is moved.
+    """
+    dest_dir = staging_dir(manifest)
+    problems = []
+    staged = []
+    for unit in manifest['units']:
+        fname = os.path.join(dest_dir, 'awstats%02d%s.%s.txt'
+                             % (unit['month'], unit['year'], manifest['outdomain']))
+        try:
+            m = AwstatsMonth(unit['year'], unit['month'], fname)
+            if 'general' not in m.keys():
+                problems.append('%s has no general section' % fname)
                 continue
+            mtime = os.stat(fname).st_mtime
+        except (IOError, OSError, IndexError, ValueError):
+            problems.append('%s is missing or unreadable' % fname)
+            continue
+
+        try:
+            newer = [source for source in unit['sources'] if os.stat(source).st_mtime > mtime]
+        except OSError, e:
+            problems.append('A source of %s is missing: %s' % (fname, e))
+            continue
+        if newer:
+            problems.append('%s is older than its sources' % fname)
+            continue
+        staged.append(fname)
+
+    if problems:
+        return problems
+
+    for fname in staged:
+        for name in (fname, fname + '.hll'):
+            if os.path.exists(name):
+                os.rename(name, os.path.join(manifest['outdir'], os.path.basename(name)))
+    try:
+        os.rmdir(dest_dir)
+    except OSError:
+        pass # Something other than our output is left in there
+    return []
 
-            data = merge_month(dom1[year][month], dom2[year][month])
-            version = sorted((dom1[year][month].version, dom2[year][month].version), reverse=True)[0]
+def main():
+    (opts, args) = get_opts()
 
-            write_file(opts.outdir, opts.outdomain, year, month, data, version)
+    if opts.worker:
+        run_worker(read_manifest(opts.worker), opts.shard[0], opts.shard[1], opts.verbose)
+    elif opts.reduce:
+        problems = run_reduce(read_manifest(opts.reduce))
+        for problem in problems:
+            print >> sys.stderr, problem
+        if problems:
+            sys.exit(1)
+    elif opts.manifest:
+        write_manifest(opts.manifest, opts)
+    elif opts.watch:
+        watch(opts)
+    else:
+        merge_all(opts)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Shows what changed between two versions of the same month's cache file.
+
+For each section with differences, prints added rows (+), removed rows (-)
+and changed rows (~) with the delta of each changed field.
+"""
+
+import optparse
+import os
+import sys
+
+from awstats_reader import AwstatsMonth, diff_months, format_value, _parse_cache_name
+
+__version__ = '0.1'
+
+def get_opts():
+
+    usage = 'usage: %prog [options] /path/to/old_file /path/to/new_file'
+    parser = optparse.OptionParser(usage=usage, version='%prog ' + __version__)
+    a = parser.add_option
+    a('-s', '--section', dest='sections', action='append', default=None,
+      help='Only compare this section. May be given more than once')
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('An old and a new file must be specified')
+
+    for fname in args:
+        if not os.path.exists(fname):
+            parser.error('No such file: %s' % fname)
+
+    return (opts, args)
+
+def open_month(fname):
+    """
+    Opens a cache file, taking the year and month from the file name when
+    it's a standard awstatsMMYYYY name
+    """
+    year, month, domain = _parse_cache_name(fname)
+    return AwstatsMonth(year, month, fname)
+
+def format_row(row):
+    return ' '.join(['%s=%s' % (f, format_value(v)) for f, v in row.items()])
+
+def format_delta(delta):
+    fields = []
+    for f, v in delta.items():
+        if isinstance(v, tuple):
+            fields.append('%s=%s->%s' % (f, format_value(v[0]), format_value(v[1])))
+        else:
+            fields.append('%s=%+d' % (f, v))
+    return ' '.join(fields)
+
+def write_diff(diff, out):
+    for section, changes in diff.items():
+        out.write('BEGIN_' + section.upper() + '\n')
+        for row_name, row in changes.added.items():
+            out.write('+ %s %s\n' % (row_name, format_row(row)))
+        for row_name, row in changes.removed.items():
+            out.write('- %s %s\n' % (row_name, format_row(row)))
+        for row_name, delta in changes.changed.items():
+            out.write('~ %s %s\n' % (row_name, format_delta(delta)))
+        out.write('END_' + section.upper() + '\n')
+
+def main():
+    (opts, args) = get_opts()
+
+    diff = diff_months(open_month(args[0]), open_month(args[1]), opts.sections)
+    write_diff(diff, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,40 @@ AwstatsReader
 A library for querying statistics from AWStats (non-XML) Cache files
 """
 
+import bz2
 import datetime
 import glob
+import gzip
+import hashlib
+import math
+import multiprocessing
+import operator
 import os
+import StringIO
+import struct
+import sys
+import tempfile
+import threading
 
 # Requires odict from http://www.voidspace.org.uk/python/odict.html
 import odict
 od = odict.OrderedDict
 d = dict
 
+# .xz files need the lzma module (backports.lzma on Python 2). Without it,
+# .xz cache files are simply not found.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_compressed_openers = {'.gz':gzip.GzipFile, '.bz2':bz2.BZ2File}
+if lzma is not None:
+    _compressed_openers['.xz'] = lzma.LZMAFile
+
 class AwstatsDateTime(datetime.datetime):
     """
     A subclass of datetime.datetime to handle AWStats' usage of
@@ -50,6 +75,189 @@ def awstats_datetime(date_string):
     else:
         raise RuntimeError("Invalid date/time string: '%s'" % date_string)
 
+def _parse_cache_name(fname):
+    """
+    Returns the (year, month, domain) of a cache file named
+    awstatsMMYYYY.<domain>.txt (optionally compressed), or (None, None, None)
+    if it isn't named that way
+    """
+    stat_name = os.path.basename(fname)
+    if not stat_name.startswith('awstats') or '.txt' not in stat_name[14:]:
+        return (None, None, None)
+    try:
+        return (int(stat_name[9:13]), int(stat_name[7:9]),
+                stat_name[14:stat_name.rindex('.txt')])
+    except ValueError:
+        return (None, None, None)
+
+def cache_file(directory, domain, year, month):
+    """
+    Returns the name of a domain's cache file for a month in a directory,
+    without listing the directory, or None if there isn't one. As with
+    cache_files, an uncompressed file wins over a compressed one.
+    """
+    fname = os.path.join(directory, 'awstats%02d%04d.%s.txt' % (month, year, domain))
+    for ext in [''] + sorted(_compressed_openers.keys()):
+        if os.path.exists(fname + ext):
+            return fname + ext
+    return None
+
+def cache_files(directory, domain):
+    """
+    Finds the cache files for a domain in a directory, and returns a dict
+    mapping (year, month) to the file name. Compressed cache files (.gz, .bz2
+    and .xz) are found too, but an uncompressed file for the same month wins.
+    """
+    files = {}
+    for ext in [''] + sorted(_compressed_openers.keys()):
+        for fname in glob.glob(os.path.join(directory, 'awstats??????.' + domain + '.txt' + ext)):
+            year, month, name = _parse_cache_name(fname)
+            if year is not None:
+                files.setdefault((year, month), fname)
+    return files
+
+def _open_cache_file(fname):
+    """
+    Opens a cache file, decompressing it if needed
+    """
+    ext = os.path.splitext(fname)[1]
+    if ext in _compressed_openers:
+        return _compressed_openers[ext](fname)
+    return open(fname)
+
+def _file_identity(fobject, fname):
+    """
+    Returns what identifies the version of an open file: AWStats (and
+    write_cache_file) replace cache files by renaming a new file over them
+    """
+    if isinstance(fobject, file):
+        st = os.fstat(fobject.fileno())
+    else:
+        # Not every decompressor gives the file descriptor
+        st = os.stat(fname)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def _file_lines(f, offset):
+    """
+    Yields the lines of an open file from offset on, closing it when done
+    """
+    try:
+        f.seek(offset)
+        for line in iter(f.readline, ''):
+            yield line
+    finally:
+        f.close()
+
+def _iter_section(lines, end_flag):
+    """
+    Yields the (row name, list of raw fields) of a section, given an
+    iterator over its lines starting at the BEGIN_ line. Raises ValueError
+    if the lines run out before the section's rows do.
+    """
+    try:
+        count = int(lines.next().split(' ')[1])
+        for x in xrange(count):
+            line_data = lines.next().strip()
+            # Seems to be an off-by-one error in some sections
+            if line_data == end_flag: # pragma: no cover
+                break
+            k,v = line_data.split(' ', 1)
+            yield k, v.split(' ')
+    except StopIteration:
+        raise ValueError("Section '%s' is truncated" % end_flag[4:].lower())
+
+def _str_fields(format, row_name):
+    """
+    Returns the positions of the fields of a row which are decoded as str
+    """
+    format = format.get(row_name, format.get('__default__'))
+    if not isinstance(format, tuple):
+        return []
+    return [index for index, f in enumerate(format) if f[1] is str]
+
+def _parse_section(lines, end_flag, intern_pool=None):
+    """
+    Parses the raw data of a section, given an iterator over its lines
+    starting at the BEGIN_ line. If an InternPool is given, the row names
+    and the fields decoded as str are interned through it. Numeric and date
+    fields are rarely shared, so are left alone.
+    """
+    if intern_pool is None:
+        return odict.OrderedDict(_iter_section(lines, end_flag))
+
+    intern = intern_pool.intern
+    format = _section_format['__default__'].get(end_flag[4:].lower(), {})
+    default_fields = _str_fields(format, '__default__')
+    rows = []
+    for k, v in _iter_section(lines, end_flag):
+        if k in format:
+            fields = _str_fields(format, k)
+        else:
+            fields = default_fields
+        for index in fields:
+            if index < len(v):
+                v[index] = intern(v[index])
+        rows.append((intern(k), v))
+    return odict.OrderedDict(rows)
+
+class InternPool(object):
+    """
+    A pool of strings shared by all the months read through it, so strings
+    which repeat from month to month (row names such as browser and OS codes,
+    robot names and URLs, and text fields such as visitors' last pages) are
+    only kept once.
+
+    If max_size is given, the pool stops taking in new strings once it holds
+    that many. Strings already in the pool are still shared.
+    """
+    def __init__(self, max_size=None):
+        self.__pool = {}
+        self.__max_size = max_size
+        self.__hits = 0
+        self.__duplicate_bytes = 0
+
+    def intern(self, s):
+        """
+        Returns the pool's copy of s, adding s to the pool if it has room
+        """
+        shared = self.__pool.get(s)
+        if shared is None:
+            if self.__max_size is None or len(self.__pool) < self.__max_size:
+                # setdefault, in case another thread added it in the meantime
+                return self.__pool.setdefault(s, s)
+            return s
+        if shared is not s:
+            # The counters are only approximate when threads share the pool
+            self.__hits += 1
+            self.__duplicate_bytes += sys.getsizeof(s)
+        return shared
+
+    def __len__(self):
+        return len(self.__pool)
+
+    def __contains__(self, s):
+        return s in self.__pool
+
+    def __get_pool_bytes(self):
+        # The pool's own dict, and the strings it keeps alive
+        return sys.getsizeof(self.__pool) + sum([sys.getsizeof(s) for s in self.__pool.keys()])
+
+    def stats(self):
+        """
+        Returns a dict with the number of strings in the pool, the number of
+        duplicates replaced by the pool's copy, the bytes those duplicates
+        would have taken, the bytes taken by the pool itself, and the net
+        bytes saved (which is negative when the pool costs more than it saves)
+        """
+        pool_bytes = self.__get_pool_bytes()
+        return {'strings':len(self.__pool), 'hits':self.__hits,
+                'duplicate_bytes':self.__duplicate_bytes, 'pool_bytes':pool_bytes,
+                'saved_bytes':self.__duplicate_bytes - pool_bytes}
+
+    hits = property(lambda self:self.__hits)
+    saved_bytes = property(lambda self:self.__duplicate_bytes - self.__get_pool_bytes())
+    max_size = property(lambda self:self.__max_size)
+
 class AttrDict(odict.OrderedDict):
     """
     Allows dicts to be accessed via dot notation as well as subscripts
@@ -57,16 +265,79 @@ class AttrDict(odict.OrderedDict):
     def __getattr__(self, name):
         return self[name]
 
+class _Row(object):
+    """
+    A decoded row kept as its list of (field name, value) tuples. It reads
+    like an AttrDict, but is much cheaper to make, so merges use it for the
+    rows they pass through unchanged.
+    """
+    def __init__(self, items):
+        self.__items = items
+
+    def __getitem__(self, name):
+        for field, value in self.__items:
+            if field == name:
+                return value
+        raise KeyError(name)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.__items)
+
+    def keys(self):
+        return [field for field, value in self.__items]
+
+    def values(self):
+        return [value for field, value in self.__items]
+
+    def items(self):
+        return list(self.__items)
+
+    def __eq__(self, other):
+        return hasattr(other, 'items') and self.items() == list(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '_Row(%r)' % self.__items
+
 class AwstatsReader(object):
     """
     The top-level object that takes the directory and domain and finds all
     the cache files, and returns the year objects given a subscript of a year
+
+    Rollup files are written by build_rollups() to 'rollup_dir', which
+    defaults to the directory of the cache files. Reading a rollup never
+    writes anything. Unique visitor sketches are only saved if a
+    'sketch_dir' is given.
     """
     years = property(lambda self:self.__year_list)
 
-    def __init__(self, directory, domain):
+    def __init__(self, directory, domain, rollup_dir=None, intern_pool=None, sketch_dir=None):
         self.__directory = directory
         self.__domain = domain
+        self.__rollup_dir = rollup_dir or directory
+        self.__sketch_dir = sketch_dir
+        # Strings are only interned if an InternPool is given. Pass the same
+        # pool to several readers to share it between them.
+        self.__intern_pool = intern_pool
         self.__years = {}
         self.__year_list = []
         self.__curr_year_index = -1
@@ -74,14 +345,12 @@ class AwstatsReader(object):
         if not os.path.exists(directory):
             raise OSError((2, 'No such directory: %s' % directory, directory))
 
-        for fname in glob.glob(os.path.join(directory, 'awstats??????.' + domain + '.txt')):
-            stat_name = os.path.basename(fname)
-            year = int(stat_name[9:13])
-            month = int(stat_name[7:9])
+        for (year, month), fname in sorted(cache_files(directory, domain).items()):
             if year not in self.__years:
-                self.__years[year] = AwstatsYear(self.__domain, year)
+                self.__years[year] = AwstatsYear(self.__domain, year, self.__rollup_dir)
 
-            self.__years[year]._set_month(month, AwstatsMonth(year, month, fname))
+            self.__years[year]._set_month(month, AwstatsMonth(year, month, fname,
+                                                              self.__intern_pool))
 
         self.__year_list = sorted(self.__years.keys())
 
@@ -100,15 +369,71 @@ class AwstatsReader(object):
     def __str__(self):
         return "<AwstatsReader: " + ', '.join([str(y) for y in self.__year_list]) + ">"
 
+    def probe(self, processes=None):
+        """
+        Probes every month's cache file (see probe_files), and returns the
+        results in date order
+        """
+        results = probe_files([m.fname for ary in self for m in ary], processes)
+        return sorted(results, key=lambda p:(p.year, p.month))
+
+    def unique_visitors(self, start=None, end=None):
+        """
+        Estimates the number of unique visitors over a range of months by
+        merging the months' HyperLogLog sketches, so visitors seen in more than
+        one month are only counted once. 'start' and 'end' are inclusive
+        (year, month) tuples, and default to the first and last months.
+        """
+        total = None
+        for ary in self:
+            for m in ary:
+                if start is not None and (m.year, m.month) < tuple(start):
+                    continue
+                if end is not None and (m.year, m.month) > tuple(end):
+                    continue
+                if total is None:
+                    total = m.unique_sketch(self.__sketch_dir)
+                else:
+                    total.merge(m.unique_sketch(self.__sketch_dir))
+
+        if total is None:
+            return 0
+        return total.estimate()
+
+    def build_rollups(self, force=False):
+        """
+        Rebuilds the rollup of each year with a month which has changed since
+        its rollup was built, then the all time rollup if any year's rollup
+        changed. Returns the list of years which were rebuilt.
+        """
+        rebuilt = [ary.year for ary in self if ary.build_rollup(force)]
+        if self.__year_list:
+            build_rollup(self.rollup_file, [ary.rollup_file for ary in self], force)
+        return rebuilt
+
+    def __get_rollup(self):
+        if (self.__year_list and
+            not [ary for ary in self if not _rollup_current(ary.rollup_file, [m.fname for m in ary])]):
+            return _open_rollup(None, self.rollup_file, [ary.rollup_file for ary in self])
+        # Some year is out of date, so merge the months themselves
+        return _open_rollup(None, self.rollup_file, [m.fname for ary in self for m in ary])
+
+    intern_pool = property(lambda self:self.__intern_pool)
+    rollup = property(__get_rollup, doc="The all time rollup. Read from the rollup "
+                      "file if it is up to date, otherwise merged in memory")
+    rollup_file = property(lambda self:os.path.join(self.__rollup_dir, 'awstats.rollup.'
+                                                    + self.__domain + '.txt'))
+
 class AwstatsYear(object):
     """
     The AWStats object containing the months for a given year
     """
-    def __init__(self, domain, year):
+    def __init__(self, domain, year, rollup_dir=None):
         self.__domain = domain
         self.__year = year
         self.__months = {}
         self.__month_list = []
+        self.__rollup_dir = rollup_dir
 
     def _set_month(self, month, mobject):
         self.__months[month] = mobject
@@ -131,61 +456,298 @@ class AwstatsYear(object):
         self.__month_list = sorted(self.__months.keys())
         return "<AwstatsYear " + str(self.__year) + ": " + ', '.join([str(m) for m in self.__month_list]) + ">"
 
+    def build_rollup(self, force=False):
+        """
+        Rebuilds the year's rollup if any of its months have changed since it
+        was built. Returns True if it was rebuilt.
+        """
+        return build_rollup(self.rollup_file, [m.fname for m in self], force)
+
+    def __get_rollup(self):
+        return _open_rollup(self.__year, self.rollup_file, [m.fname for m in self])
+
+    def __get_rollup_file(self):
+        rollup_dir = self.__rollup_dir
+        if rollup_dir is None:
+            rollup_dir = os.path.dirname(self.__months[self.__month_list[0]].fname)
+        return os.path.join(rollup_dir, 'awstats%s.rollup.%s.txt' % (self.__year, self.__domain))
+
     months = property(lambda self:self.__month_list)
     year = property(lambda self:self.__year)
+    rollup = property(__get_rollup, doc="The year's rollup. Read from the rollup file "
+                      "if it is up to date, otherwise merged in memory")
+    rollup_file = property(__get_rollup_file)
 
 class AwstatsMonth(object):
     """
-    The AWStats object containing the sections for a given month
+    The AWStats object containing the sections for a given month. If
+    'contents' is given, it is used as the contents of the file instead of
+    reading fname.
     """
-    def __init__(self, year, month, fname):
+    def __init__(self, year, month, fname, intern_pool=None, contents=None):
         self.__year = year
         self.__month = month
         self.__version = None
         self.__fname = fname
+        self.__intern_pool = intern_pool
         self.__pos_map = {}
         self.__section_list = []
         self.__section_cache = {}
-        self.__fobject = None
+        self.__initialized = False
+        self.__contents = contents
+        # Contents given up front are read like an already decompressed file
+        self.__compressed = (contents is not None or
+                             os.path.splitext(fname)[1] in _compressed_openers)
+        # The decompression stream of a compressed file, the offset it has
+        # reached, and what has been read from it but not used yet
+        self.__stream = None
+        self.__stream_pos = 0
+        self.__pending = ''
+        self.__identity = None # The version of the file the map was read from
+        # Guards the lazy loading of the map and decompression. Section reads
+        # of uncompressed files don't share any state, so need no lock.
+        self.__lock = threading.Lock()
 
     def __init_file(self):
-        self.__fobject = open(self.__fname)
+        if self.__initialized:
+            return
 
-        version = self.__fobject.readline().split()[3:6]
+        self.__lock.acquire()
+        try:
+            if self.__initialized:
+                return # Another thread got here first
+
+            self.__load_map()
+            self.__initialized = True
+        finally:
+            self.__lock.release()
+
+    def __load_map(self):
+        """
+        Reads the version and the map of sections. Called with the lock held.
+        """
+        if self.__contents is not None:
+            fobject = StringIO.StringIO(self.__contents)
+        else:
+            fobject = _open_cache_file(self.__fname)
+
+        version = fobject.readline().split()[3:6]
         self.__version = (version[0], version[2].replace(')',''))
 
-        for line in self.__fobject:
+        pos_map = {}
+        section_list = []
+        for line in fobject:
             if line.startswith('POS_'):
                 # The Map lines (and others for that matter) have trailing spaces
                 # Truly odd
                 k,v = line.split(' ', 1)
                 k = k[4:].lower()
-                self.__pos_map[k] = int(v)
-                self.__section_list.append(k)
+                pos_map[k] = int(v)
+                section_list.append(k)
             if line.startswith('END_MAP'):
                 break
+        self.__pos_map = pos_map
+        self.__section_list = section_list
+
+        if self.__contents is None:
+            self.__identity = _file_identity(fobject, self.__fname)
+        fobject.close()
+
+    def __reload(self, identity):
+        """
+        Reads the map again, after finding the file has been replaced by the
+        version 'identity'. Sections already loaded are dropped, as they
+        came from the old file.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__identity != identity:
+                self.__load_map()
+                self.__section_cache = {}
+        finally:
+            self.__lock.release()
+
+    def __open_stream(self):
+        """
+        Starts decompressing the file again from the beginning, reading the
+        map again if the file has been replaced. Called with the lock held.
+        """
+        self.__close_stream()
+        self.__stream = _open_cache_file(self.__fname)
+        if _file_identity(self.__stream, self.__fname) != self.__identity:
+            self.__load_map()
+            self.__section_cache = {}
+
+    def __close_stream(self):
+        if self.__stream is not None:
+            self.__stream.close()
+        self.__stream = None
+        self.__stream_pos = 0
+        self.__pending = ''
+
+    def __read_compressed(self, name, end_flag):
+        """
+        Compressed files can't be seeked, so they are decompressed as a
+        stream. The stream is kept open between reads, so reading sections
+        in the order they are in the file decompresses it only once, and it
+        is closed at the end of the file. Reading a section the stream has
+        already passed decompresses the file again from the start. Only the
+        section being read is kept in memory. Returns the lines of the
+        section.
+        """
+        flag = '\n' + end_flag
+        if self.__contents is not None:
+            offset = self.__pos_map[name]
+            end = self.__contents.find(flag, offset)
+            if end == -1:
+                return self.__contents[offset:].split('\n')
+            return self.__contents[offset:end + len(flag)].split('\n')
+
+        self.__lock.acquire()
+        try:
+            offset = self.__pos_map[name]
+            if (offset < self.__stream_pos or (self.__stream is None and
+                self.__pending.find(flag, offset - self.__stream_pos) == -1)):
+                self.__open_stream()
+                offset = self.__pos_map[name]
+
+            stream_pos = self.__stream_pos
+            pending = self.__pending
+            searched = 0
+            while True:
+                # Drop what comes before the section
+                if stream_pos + len(pending) <= offset:
+                    stream_pos += len(pending)
+                    pending = ''
+                elif stream_pos < offset:
+                    pending = pending[offset - stream_pos:]
+                    stream_pos = offset
+                    searched = 0
+
+                if stream_pos == offset:
+                    end = pending.find(flag, max(0, searched - len(flag)))
+                    if end != -1:
+                        end += len(flag)
+                        break
+                    searched = len(pending)
+
+                if self.__stream is None:
+                    # Truncated. Leave out any partial last line, so
+                    # _iter_section finds the lines run out.
+                    self.__stream_pos = stream_pos + len(pending)
+                    self.__pending = ''
+                    return pending.split('\n')[:-1]
+                # Read at least as much as we have, so growing pending is linear
+                chunk = self.__stream.read(max(65536, len(pending)))
+                if not chunk:
+                    self.__stream.close()
+                    self.__stream = None
+                pending += chunk
+
+            self.__stream_pos = stream_pos + end
+            self.__pending = pending[end:]
+            if offset == max(self.__pos_map.values()) and self.__stream is not None:
+                # Nothing useful follows the last section
+                self.__stream.close()
+                self.__stream = None
+            return pending[:end].split('\n')
+        finally:
+            self.__lock.release()
+
+    def __section_lines(self, name, end_flag):
+        """
+        Returns an iterator over the lines of a section, starting with its
+        BEGIN_ line. Uncompressed files are read through a file object of the
+        caller's own, so threads never share a file position. If the file has
+        been replaced since its map was read, the map is read again first.
+        """
+        if self.__compressed:
+            return iter(self.__read_compressed(name, end_flag))
+
+        for attempt in xrange(3):
+            f = open(self.__fname)
+            identity = _file_identity(f, self.__fname)
+            if identity == self.__identity:
+                return _file_lines(f, self.__pos_map[name])
+            f.close()
+            self.__reload(identity)
+        raise IOError("'%s' keeps changing while it is being read" % self.__fname)
 
     def __get_raw_section(self, name):
-        section_data = odict.OrderedDict()
-        k = v = ''
         end_flag = 'END_' + name.upper()
-        self.__fobject.seek(self.__pos_map[name])
-        lines = int(self.__fobject.readline().split(' ')[1])
-        for x in xrange(lines):
-            line_data = self.__fobject.readline().strip()
-            # Seems to be an off-by-one error in some sections
-            if line_data == end_flag: # pragma: no cover
+        return _parse_section(self.__section_lines(name, end_flag), end_flag,
+                              self.__intern_pool)
+
+    def raw_rows(self, name):
+        """
+        Yields the (row name, list of raw fields) of a section straight from
+        the file, without decoding or caching the section
+        """
+        self.__init_file()
+        if name not in self.__pos_map:
+            raise KeyError("Section '%s' does not exist" % name)
+
+        end_flag = 'END_' + name.upper()
+        return _iter_section(self.__section_lines(name, end_flag), end_flag)
+
+    def unique_sketch(self, sketch_dir=None):
+        """
+        Returns a HyperLogLog sketch of the month's unique visitors (hosts
+        with at least one page view, which is what general.TotalUnique
+        counts). A saved sketch is used if the cache file hasn't changed since
+        it was saved: from 'sketch_dir' if given, otherwise from next to the
+        cache file (where merging saves them). Otherwise the sketch is built
+        from the visitor section, and saved in 'sketch_dir' if given. Nothing
+        is written without a 'sketch_dir'.
+        """
+        if sketch_dir is None:
+            sketch_name = self.__fname + '.hll'
+        else:
+            sketch_name = os.path.join(sketch_dir, os.path.basename(self.__fname) + '.hll')
+        signature = _file_signature(self.__fname)
+        try:
+            saved_signature, sketch = HyperLogLog.load(sketch_name)
+            if saved_signature == signature:
+                return sketch
+        except (IOError, ValueError):
+            pass
+
+        sketch = HyperLogLog()
+        for host, fields in self.raw_rows('visitor'):
+            if int(fields[0]) > 0:
+                sketch.add(host)
+
+        if sketch_dir is not None:
+            sketch.save(sketch_name, signature)
+        return sketch
+
+    def section_digest(self, name):
+        """
+        Returns an md5 digest of the raw text of a section, without decoding
+        it. Sections with the same digest hold the same data.
+        """
+        self.__init_file()
+        if name not in self.__pos_map:
+            raise KeyError("Section '%s' does not exist" % name)
+
+        end_flag = 'END_' + name.upper()
+        digest = hashlib.md5()
+        for line in self.__section_lines(name, end_flag):
+            # Ignore the trailing spaces AWStats pads some lines with
+            line = line.strip()
+            digest.update(line + '\n')
+            if line == end_flag:
                 break
-            k,v = line_data.split(' ', 1)
-            section_data[k] = v.split(' ')
-        return section_data
+        return digest.hexdigest()
 
     def __get_section(self, name):
-        if not self.__fobject:
-            self.__init_file()
+        self.__init_file()
         try:
             if name not in self.__section_cache:
-                self.__section_cache[name] = AwstatsSection(self.__version, name, self.__get_raw_section(name))
+                # If two threads load the same section, both get the one which
+                # was cached first
+                return self.__section_cache.setdefault(
+                    name, AwstatsSection(self.__version, name, self.__get_raw_section(name)))
             return self.__section_cache[name]
         except KeyError:
             raise KeyError("Section '%s' does not exist" % name)
@@ -194,16 +756,14 @@ class AwstatsMonth(object):
         """
         Iterates through the list of sections in the month
         """
-        if not self.__fobject:
-            self.__init_file()
+        self.__init_file()
         return (s for s in self.__section_list)
 
     def __len__(self):
         """
         Returns the number of sections in the month
         """
-        if not self.__fobject:
-            self.__init_file() # pragma: no cover
+        self.__init_file()
         return len(self.__section_list)
 
     def __str__(self):
@@ -213,13 +773,192 @@ class AwstatsMonth(object):
     __getattr__ = __get_section
 
     def keys(self):
-        if not self.__fobject:
-            self.__init_file()
+        self.__init_file()
         return self.__section_list
 
     version = property(lambda self:self.__version)
     year = property(lambda self:self.__year)
     month = property(lambda self:self.__month)
+    fname = property(lambda self:self.__fname)
+
+def save_unique_sketch(fname, sketch):
+    """
+    Saves 'sketch' as the unique visitor sketch of the cache file 'fname'.
+    Used when the sketch is already known, such as when it is the merge of
+    the sketches of the files which were merged into 'fname'.
+    """
+    sketch.save(fname + '.hll', _file_signature(fname))
+
+def set_total_unique(data):
+    """
+    Sets general.TotalUnique of merged data (as returned by merge_data) from
+    its merged visitor section. Merging sums TotalUnique, which counts any
+    visitor seen in both halves twice.
+    """
+    if 'general' in data and 'visitor' in data and 'TotalUnique' in data['general']:
+        unique = len([1 for row in data['visitor'].values() if row['pages'] > 0])
+        data['general']['TotalUnique'] = AttrDict([('value', unique)])
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog sketch, which estimates the number of distinct keys added
+    to it in constant memory (2**precision bytes). Sketches with the same
+    precision can be merged, giving the sketch of the union of their keys.
+    The standard error is about 1.04 / sqrt(2**precision): 0.8% by default.
+    """
+    def __init__(self, precision=14, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision must be between 4 and 16, not %s' % precision)
+        self.__precision = precision
+        self.__size = 1 << precision
+        if registers is None:
+            registers = bytearray(self.__size)
+        elif len(registers) != self.__size:
+            raise ValueError('Expected %s registers, got %s' % (self.__size, len(registers)))
+        self.__registers = registers
+
+    def add(self, key):
+        x = struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+        index = x >> (64 - self.__precision)
+        w = x & ((1 << (64 - self.__precision)) - 1)
+        rank = 64 - self.__precision - w.bit_length() + 1
+        if rank > self.__registers[index]:
+            self.__registers[index] = rank
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one, and returns this one
+        """
+        if other.precision != self.__precision:
+            raise ValueError('Cannot merge HyperLogLog sketches of precision %s and %s'
+                             % (self.__precision, other.precision))
+        self.__registers = bytearray(map(max, self.__registers, other.registers))
+        return self
+
+    def estimate(self):
+        m = self.__size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum([2.0 ** -r for r in self.__registers])
+        zeros = self.__registers.count(chr(0))
+        if e <= 2.5 * m and zeros:
+            # Small range correction: linear counting
+            e = m * math.log(float(m) / zeros)
+        return int(round(e))
+
+    __len__ = estimate
+
+    def save(self, fname, signature=''):
+        """
+        Saves the sketch, along with the signature of the file it describes
+        """
+        _atomic_write(fname, 'HLL %d %s\n' % (self.__precision, signature)
+                      + str(self.__registers))
+
+    def load(cls, fname):
+        """
+        Loads a saved sketch, returning (signature, sketch)
+        """
+        f = open(fname, 'rb')
+        try:
+            header = f.readline().rstrip('\n').split(' ', 2)
+            if len(header) != 3 or header[0] != 'HLL':
+                raise IOError("'%s' is not a HyperLogLog sketch" % fname)
+            return header[2], cls(int(header[1]), bytearray(f.read()))
+        finally:
+            f.close()
+    load = classmethod(load)
+
+    precision = property(lambda self:self.__precision)
+    registers = property(lambda self:self.__registers)
+
+class AwstatsRollup(AwstatsMonth):
+    """
+    The AWStats object containing the sections of a rollup: all the months
+    of a year (or all the years) merged into one cache file
+    """
+    def __init__(self, year, fname, contents=None):
+        AwstatsMonth.__init__(self, year, None, fname, contents=contents)
+
+    def __str__(self):
+        if self.year is None:
+            return "<AwstatsRollup all>"
+        return "<AwstatsRollup " + str(self.year) + ">"
+
+def _file_signature(fname):
+    st = os.stat(fname)
+    return '%s %s %r' % (os.path.basename(fname), st.st_size, st.st_mtime)
+
+def _rollup_sources(fname):
+    """
+    Returns the source signatures recorded in a rollup file, or None if the
+    file doesn't exist
+    """
+    try:
+        f = open(fname)
+    except IOError:
+        return None
+
+    sources = []
+    for line in f:
+        if line.startswith('# SOURCE '):
+            sources.append(line[9:].rstrip('\n'))
+        elif line.startswith('BEGIN_MAP'):
+            break
+    f.close()
+    return sources
+
+def _rollup_current(fname, sources):
+    """
+    Returns True if the rollup file 'fname' exists and was built from the
+    current versions of 'sources'
+    """
+    try:
+        signatures = [_file_signature(source) for source in sources]
+    except OSError:
+        return False
+    return _rollup_sources(fname) == signatures
+
+def _merge_files(sources):
+    """
+    Merges the cache files named in 'sources', returning (data, version)
+    """
+    data = od()
+    version = None
+    for source in sources:
+        m = AwstatsMonth(None, None, source)
+        data = merge_data(data, month_data(m))
+        version = max(version, m.version)
+    set_total_unique(data)
+    return data, version
+
+def _open_rollup(year, fname, sources):
+    """
+    Returns the rollup in 'fname' if it is up to date with 'sources'.
+    Otherwise 'sources' are merged in memory; nothing is written.
+    """
+    if _rollup_current(fname, sources):
+        return AwstatsRollup(year, fname)
+    data, version = _merge_files(sources)
+    return AwstatsRollup(year, fname, _cache_file_text(data, version))
+
+def build_rollup(fname, sources, force=False):
+    """
+    Merges the cache files named in 'sources' (months, or other rollups) into
+    the rollup file 'fname', using the same rules as merging months. The size
+    and mtime of each source are recorded in the rollup, and it is only
+    rebuilt when they no longer match (or 'force' is True). Returns True if
+    the rollup was rebuilt.
+    """
+    if not sources:
+        raise ValueError("No cache files to roll up into '%s'" % fname)
+
+    if not force and _rollup_current(fname, sources):
+        return False
+
+    signatures = [_file_signature(source) for source in sources]
+    data, version = _merge_files(sources)
+    write_cache_file(fname, data, version, ['SOURCE ' + sig for sig in signatures])
+    return True
 
 
 class AwstatsSection(object):
@@ -234,7 +973,10 @@ class AwstatsSection(object):
     def __str__(self):
         return "<AwstatsSection %s, %s>" % (self.__name, self.__data)
 
-    def __get_data(self, row_name):
+    def __get_items(self, row_name):
+        """
+        Decodes a row into a list of (field name, value) tuples
+        """
         data = self.__data[row_name]
         if row_name in self.__format:
             format = self.__format[row_name]
@@ -242,15 +984,21 @@ class AwstatsSection(object):
             format = self.__format['__default__']
 
         if isinstance(format, tuple):
-            items = odict.OrderedDict()
+            items = []
             for index, f in enumerate(format):
                 if len(f) == 3 and f[2] == 'opt' and len(data) <= index:
                     break # TODO: Why isn't this being triggered in testing?
-                items[f[0]] = f[1](data[index])
-            return AttrDict(items)
+                items.append((f[0], f[1](data[index])))
+            return items
         else:
             return format(data[0]) # TODO: Why isn't this being triggered in testing?
 
+    def __get_data(self, row_name):
+        items = self.__get_items(row_name)
+        if isinstance(items, list):
+            return AttrDict(items)
+        return items # pragma: no cover
+
     __getitem__ = __get_data
     __getattr__ = __get_data
 
@@ -273,25 +1021,7 @@ class AwstatsSection(object):
         return ((k,self.__data[k]) for k in self.__data.keys())
 
     def get_sort_info(self):
-        sort_num = None
-        sort_by = None
-        sort_reversed = None
-
-        if '__meta__' in self.__format:
-            sort_num = self.__format['__meta__'].get('sort', None)
-            sort_by = self.__format['__meta__'].get('sortby', None)
-            sort_reversed = self.__format['__meta__'].get('reversed', True)
-
-        return (sort_num, sort_by, sort_reversed)
-
-    def __merge_sum(v1, v2):
-        return v1 + v2
-
-    def __merge_min(v1, v2):
-        return min(v1, v2)
-
-    def __merge_max(v1, v2):
-        return max(v1, v2)
+        return _sort_info(self.__name)
 
     def __merge_latest(v1, v2):
         """
@@ -301,28 +1031,487 @@ class AwstatsSection(object):
         """
         return v2
 
-    merge_funcs = {'sum':__merge_sum, 'min':__merge_min,
-                   'max':__merge_max, 'latest':__merge_latest}
+    merge_funcs = {'sum':operator.add, 'min':min,
+                   'max':max, 'latest':__merge_latest}
 
     def merge(self, other, row_name, field_name):
         """
         'other' is the AwstatsSection object with which we are merging
         """
-        if row_name in _section_merge_rules['__default__'][self.__name]:
-            merge_rule = _section_merge_rules['__default__'][self.__name][row_name][field_name]
+        return _merge_plan(self.__name, row_name)[field_name](self.get(row_name)[field_name],
+                                                              other.get(row_name)[field_name])
+
+    def merge_section(self, other):
+        """
+        Merges the whole of this section with 'other' in one pass, and returns
+        an ordered dict of row name -> row. Rows are in the order they appear
+        in this section, followed by the rows only found in 'other'.
+        Each row is decoded once, and the merge rules are only looked up once
+        per section (or once per row name, for sections like 'general' which
+        have per-row rules). Merged rows are AttrDicts; rows found in only one
+        section are passed through as read-only rows which read like them.
+        Rows are still merged one at a time, not column by column.
+        """
+        return _merge_rows(self.__name, self.__data, self.__get_items,
+                           other.__data, other.__get_items,
+                           lambda r: _Row(self.__get_items(r)),
+                           lambda r: _Row(other.__get_items(r)))
+
+def _merge_rows(section_name, rows1, get1, rows2, get2, keep1, keep2):
+    """
+    Merges the rows of two versions of a section. 'rows1' and 'rows2' hold
+    the row names of each (anything supporting iteration and 'in'), and
+    'get1' and 'get2' return a row as a list of (field name, value) tuples.
+    'keep1' and 'keep2' return the row to use as it is when only one side
+    has it. Returns an ordered dict of row name -> row, with rows in the
+    order of 'rows1', followed by the rows only found in 'rows2'.
+    """
+    rules = _section_merge_rules['__default__'][section_name]
+    default_plan = _merge_plan(section_name, '__default__')
+
+    data = od()
+    for row_name in rows1:
+        if row_name not in rows2:
+            data[row_name] = keep1(row_name)
+            continue
+        i1 = get1(row_name)
+        i2 = get2(row_name)
+
+        if row_name in rules:
+            plan = _merge_plan(section_name, row_name)
         else:
-            merge_rule = _section_merge_rules['__default__'][self.__name]['__default__'][field_name]
+            plan = default_plan
+
+        data[row_name] = _merge_items(plan, i1, i2)
+
+    for row_name in rows2:
+        if row_name not in data:
+            data[row_name] = keep2(row_name)
+
+    return data
+
+def _merge_items(plan, i1, i2):
+    """
+    Merges two decoded rows, given as lists of (field name, value) tuples
+    """
+    # Both rows share a format, so fields line up by position. Optional
+    # fields are always at the end, so the longer row supplies those.
+    n = min(len(i1), len(i2))
+    row = [(f, plan[f](v1, v2)) for (f, v1), (f2, v2) in zip(i1[:n], i2[:n])]
+    row.extend((len(i1) > n and i1 or i2)[n:])
+    return AttrDict(row)
+
+def _merge_repl(value):
+    def merge_repl(v1, v2):
+        return value
+    return merge_repl
+
+_merge_plans = {}
+
+def _merge_plan(section_name, row_name):
+    """
+    Resolves the merge rules for a row into a dict of field name -> merge
+    function. Plans are cached, so the rules for a section are only parsed
+    once.
+    """
+    rules = _section_merge_rules['__default__'][section_name]
+    if row_name not in rules:
+        row_name = '__default__'
+
+    try:
+        return _merge_plans[(section_name, row_name)]
+    except KeyError:
+        pass
 
+    plan = {}
+    for field_name, merge_rule in rules[row_name].items():
         if merge_rule.startswith('repl'):
             c,v = merge_rule.split(':',1)
-            return str(v)
+            plan[field_name] = _merge_repl(str(v))
+        elif merge_rule in AwstatsSection.merge_funcs:
+            plan[field_name] = AwstatsSection.merge_funcs[merge_rule]
         else:
-            try:
-                return AwstatsSection.merge_funcs[merge_rule](self.get(row_name)[field_name],
-                                                              other.get(row_name)[field_name])
-            except KeyError: # TODO: Need a way to trigger this error
-                raise RuntimeError("Unhandled merge rule for section '%s', row '%s', field '%s': '%s'"
-                                   % (self.__name, row_name, field_name, merge_rule))
+            raise RuntimeError("Unhandled merge rule for section '%s', row '%s', field '%s': '%s'"
+                               % (section_name, row_name, field_name, merge_rule))
+
+    _merge_plans[(section_name, row_name)] = plan
+    return plan
+
+def _sort_info(section_name):
+    sort_num = None
+    sort_by = None
+    sort_reversed = None
+
+    format = _section_format['__default__'][section_name]
+    if '__meta__' in format:
+        sort_num = format['__meta__'].get('sort', None)
+        sort_by = format['__meta__'].get('sortby', None)
+        sort_reversed = format['__meta__'].get('reversed', True)
+
+    return (sort_num, sort_by, sort_reversed)
+
+def sort_section(section_name, rows):
+    """
+    Sorts the rows of a section (an ordered dict of row name -> row) in the
+    order AWStats keeps them, and returns them as a new ordered dict
+    """
+    sort_num, sort_by, sort_reversed = _sort_info(section_name)
+    if not sort_num:
+        return rows
+    if sort_by == 'key':
+        return od(sorted(rows.iteritems()))
+    elif sort_by == 'key_int':
+        return od(sorted(rows.iteritems(), key=lambda x: int(x[0])))
+    else:
+        return od(sorted(rows.iteritems(), key=make_get_field(sort_by), reverse=sort_reversed))
+
+def month_data(m):
+    """
+    Returns all the decoded data of a month (or rollup), as an ordered dict
+    of section name -> ordered dict of row name -> row
+    """
+    data = od()
+    for section in m.keys():
+        data[section] = od([(row, m[section][row]) for row in m[section]])
+    return data
+
+def merge_data(data1, data2):
+    """
+    Merges two sets of decoded data, as returned by month_data, by the same
+    rules as AwstatsSection.merge_section. Sections are sorted after merging.
+    Rows and sections found on only one side are used as they are, not
+    copied.
+    """
+    data = od()
+    sections = od([(k, True) for k in data1.keys()])
+    sections.update(od([(k, True) for k in data2.keys()]))
+
+    for section in sections:
+        if section not in data2:
+            data[section] = data1[section]
+            continue
+        elif section not in data1:
+            data[section] = data2[section]
+            continue
+
+        rows1 = data1[section]
+        rows2 = data2[section]
+        merged = _merge_rows(section, rows1, lambda r: rows1[r].items(),
+                             rows2, lambda r: rows2[r].items(),
+                             rows1.__getitem__, rows2.__getitem__)
+        data[section] = sort_section(section, merged)
+
+    return data
+
+def write_cache_file(fname, data, version, comments=()):
+    """
+    Writes data (as returned by month_data or merge_data) out as an AWStats
+    cache file, with a map so it can be read back. 'comments' are written as
+    '#' lines after the version line.
+    """
+    _atomic_write(fname, _cache_file_text(data, version, comments))
+
+def _cache_file_text(data, version, comments=()):
+    """
+    Returns the text of the cache file write_cache_file writes
+    """
+    sections = []
+    for section in data.keys():
+        lines = ['BEGIN_%s %d\n' % (section.upper(), len(data[section]))]
+        for row_name, row in data[section].items():
+            row_data = [row_name] # The row name/key
+            for field, value in row.items():
+                row_data.append(format_value(value))
+            lines.append(' '.join(row_data) + '\n')
+        lines.append('END_%s\n\n' % section.upper())
+        sections.append((section, ''.join(lines)))
+
+    header = 'AWSTATS DATA FILE %s (build %s)\n' % version
+    header += ''.join(['# %s\n' % c for c in comments]) + '\n'
+
+    # Offsets are padded to a fixed width, as AWStats does, so the length of
+    # the map is known before the offsets are
+    pos_line = 'POS_%s %-20d\n'
+    map_len = len('BEGIN_MAP %d\n' % len(sections)) + len('END_MAP\n\n')
+    map_len += sum([len(pos_line % (section.upper(), 0)) for section, text in sections])
+    offset = len(header) + map_len
+
+    map_lines = ['BEGIN_MAP %d\n' % len(sections)]
+    for section, text in sections:
+        map_lines.append(pos_line % (section.upper(), offset))
+        offset += len(text)
+    map_lines.append('END_MAP\n\n')
+
+    return header + ''.join(map_lines) + ''.join([text for section, text in sections])
+
+def _atomic_write(fname, data):
+    """
+    Writes data to a temporary file next to fname, and renames it into
+    place, so readers never see a partially written file
+    """
+    fd, tmp_name = tempfile.mkstemp(prefix='.awstats', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(fname)))
+    outfile = os.fdopen(fd, 'wb')
+    try:
+        outfile.write(data)
+        outfile.close()
+        os.chmod(tmp_name, 0644)
+        os.rename(tmp_name, fname)
+    except:
+        outfile.close()
+        os.unlink(tmp_name)
+        raise
+
+def format_value(value):
+    """
+    Formats a decoded field value the way AWStats writes it in a cache file
+    """
+    if isinstance(value, AwstatsDateTime):
+        return value.strftime('%Y%m%d%H%M%S')
+    elif isinstance(value, AwstatsDate):
+        return value.strftime('%Y%m%d')
+    return str(value)
+
+def _field_delta(v1, v2):
+    if isinstance(v1, (int, long)) and isinstance(v2, (int, long)):
+        return v2 - v1
+    return (v1, v2)
+
+def diff_months(old, new, sections=None):
+    """
+    Compares two versions of a month (AwstatsMonth objects), section by
+    section. Returns an ordered dict of section name -> AttrDict with:
+
+        added: ordered dict of row name -> row, for rows only in 'new'
+        removed: ordered dict of row name -> row, for rows only in 'old'
+        changed: ordered dict of row name -> AttrDict of field -> delta
+
+    Deltas of numeric fields are new - old; other changed fields are an
+    (old, new) tuple. Only sections with differences are included. Sections
+    whose raw text is identical are skipped without being decoded, and rows
+    are compared raw, so only added, removed and changed rows get decoded.
+    'sections' optionally limits the comparison to a list of section names.
+    """
+    diff = od()
+    old_sections = old.keys()
+    new_sections = new.keys()
+    all_sections = od([(k, True) for k in old_sections])
+    all_sections.update(od([(k, True) for k in new_sections]))
+
+    for name in all_sections:
+        if sections is not None and name not in sections:
+            continue
+        s1 = s2 = None
+        raw1 = raw2 = {}
+        if name in old_sections:
+            if name in new_sections and old.section_digest(name) == new.section_digest(name):
+                continue
+            s1 = old[name]
+            raw1 = dict(s1.items())
+        if name in new_sections:
+            s2 = new[name]
+            raw2 = dict(s2.items())
+
+        added = od()
+        removed = od()
+        changed = od()
+        if s2 is not None:
+            for row_name in s2:
+                if row_name not in raw1:
+                    added[row_name] = s2[row_name]
+                elif raw1[row_name] != raw2[row_name]:
+                    r1 = s1[row_name]
+                    r2 = s2[row_name]
+                    fields = r1.keys() + [f for f in r2.keys() if f not in r1]
+                    deltas = AttrDict([(f, _field_delta(r1.get(f), r2.get(f)))
+                                       for f in fields if r1.get(f) != r2.get(f)])
+                    if deltas:
+                        changed[row_name] = deltas
+        if s1 is not None:
+            for row_name in s1:
+                if row_name not in raw2:
+                    removed[row_name] = s1[row_name]
+
+        if added or removed or changed:
+            diff[name] = AttrDict([('added', added), ('removed', removed), ('changed', changed)])
+
+    return diff
+
+def _query_file(task):
+    """
+    Runs the selectors of a batch query against one cache file
+    """
+    domain, year, month, fname, selectors = task
+    try:
+        m = AwstatsMonth(year, month, fname)
+        sections = m.keys()
+        values = []
+        for section, row, field in selectors:
+            if section not in sections:
+                values.append(None)
+            elif row is None:
+                s = m[section]
+                column = [s[r].get(field) for r in s]
+                if [v for v in column if not isinstance(v, (int, long))]:
+                    # Missing, or not a number that can be summed
+                    values.append(None)
+                else:
+                    values.append(sum(column))
+            else:
+                r = m[section].get(row)
+                if r is None:
+                    values.append(None)
+                else:
+                    values.append(r.get(field))
+    except (IOError, OSError, IndexError, ValueError, RuntimeError, TypeError), e:
+        # One bad file shouldn't stop the rest of the batch. awstats_datetime
+        # raises RuntimeError for a bad date
+        return (domain, year, month, None, '%s: %s' % (fname, e))
+    return (domain, year, month, values, None)
+
+def batch_query(directory, domains, selectors, start=None, end=None, processes=None):
+    """
+    Runs the same query against many domains' cache files in 'directory',
+    spreading the files over a pool of 'processes' worker processes (by
+    default, one per CPU; 1 runs everything in this process).
+
+    'selectors' is a list of (section, row, field). A row of None selects
+    the sum of the field over every row of the section, so ('day', None,
+    'bandwidth') is the month's bandwidth. 'start' and 'end' are inclusive
+    (year, month) tuples limiting the months queried.
+
+    Only the sections named in the selectors are read. Results are yielded
+    as each file finishes, in no particular order, as (domain, year, month,
+    values, error), with a value for each selector (None where the section,
+    row or field doesn't exist, or a summed field isn't a number). If a file can't be read, its values are None
+    and error describes why; otherwise error is None.
+    """
+    selectors = [tuple(selector) for selector in selectors]
+    tasks = []
+    for domain in domains:
+        for (year, month), fname in sorted(cache_files(directory, domain).items()):
+            if start is not None and (year, month) < tuple(start):
+                continue
+            if end is not None and (year, month) > tuple(end):
+                continue
+            tasks.append((domain, year, month, fname, selectors))
+
+    return _run_pool(_query_file, tasks, processes, 8)
+
+def _run_pool(func, tasks, processes=None, chunksize=1):
+    """
+    Yields func(task) for each task, spread over a pool of 'processes' worker
+    processes (None meaning one per CPU) and in the order they finish. With
+    one process, the tasks are run in order in this process. func must be a
+    module level function, so the pool can pickle it.
+    """
+    if processes == 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(func, tasks, chunksize=chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _read_head(fname, size, offset=0):
+    f = _open_cache_file(fname)
+    try:
+        if offset:
+            f.seek(offset)
+        return f.read(size)
+    finally:
+        f.close()
+
+def _probe_raw(task):
+    """
+    Probes one cache file, returning (fname, version, sections, raw general
+    section, error)
+    """
+    fname, size = task
+    try:
+        version, sections, general = _read_probe(fname, size)
+    except (IOError, OSError, IndexError, ValueError), e:
+        # One bad file shouldn't stop the rest of a sweep
+        return (fname, None, None, None, str(e))
+    return (fname, version, sections, general, None)
+
+def _read_probe(fname, size):
+    """
+    Reads the version, map and raw general section of a cache file, usually
+    with a single read of its first 'size' bytes
+    """
+    head = _read_head(fname, size)
+    # The map didn't fit; very unlikely with the default size
+    while '\nEND_MAP' not in head and len(head) == size:
+        size *= 2
+        head = _read_head(fname, size)
+
+    lines = head.split('\n')
+    version = lines[0].split()[3:6]
+    version = (version[0], version[2].replace(')',''))
+
+    sections = []
+    for line in lines[1:]:
+        if line.startswith('POS_'):
+            k,v = line.split(' ', 1)
+            sections.append((k[4:].lower(), int(v)))
+        if line.startswith('END_MAP'):
+            break
+    if not sections:
+        raise ValueError("'%s' has no map of its sections" % fname)
+
+    general = []
+    offsets = dict(sections)
+    if 'general' in offsets:
+        offset = offsets['general']
+        text = head[offset:]
+        if '\nEND_GENERAL' not in text and len(head) == size:
+            # The general section runs past the first read
+            text = _read_head(fname, size, offset)
+            while '\nEND_GENERAL' not in text and len(text) == size:
+                size *= 2
+                text = _read_head(fname, size, offset)
+        general = list(_iter_section(iter(text.split('\n')), 'END_GENERAL'))
+
+    return (version, [name for name, pos in sections], general)
+
+def _make_probe(raw):
+    fname, version, sections, general, error = raw
+    year, month, domain = _parse_cache_name(fname)
+    if general is not None:
+        general = AwstatsSection(version, 'general', od(general))
+    return AttrDict([('fname', fname), ('year', year), ('month', month),
+                     ('version', version), ('sections', sections),
+                     ('general', general), ('error', error)])
+
+def probe(fname, size=8192):
+    """
+    Cheaply reads just the version, the list of sections and the general
+    section of a cache file, without opening it as an AwstatsMonth. The
+    general section is near the start of the file, so this is usually one
+    read of the first 'size' bytes (a second read is made if the general
+    section doesn't fit). Returns an AttrDict of fname, year, month, version,
+    sections, general (an AwstatsSection) and error. If the file can't be
+    read, error describes why and version, sections and general are None;
+    otherwise error is None.
+    """
+    return _make_probe(_probe_raw((fname, size)))
+
+def probe_files(fnames, processes=None, size=8192):
+    """
+    Probes many cache files (see probe), spreading them over a pool of
+    'processes' worker processes (by default, one per CPU; 1 runs everything
+    in this process). Results are yielded as each file finishes.
+    """
+    tasks = [(fname, size) for fname in fnames]
+    for raw in _run_pool(_probe_raw, tasks, processes, 64):
+        yield _make_probe(raw)
 
 def make_get_field(field_name):
     """
@@ -338,7 +1527,8 @@ _section_format = {}
 
 _section_format['__default__'] = {
     'general':{
-        'LastLine':(('date',awstats_datetime),('line',int),('offset',long),('signature',long)),
+        # Merging blanks the signature, so it is optional when reading merged files
+        'LastLine':(('date',awstats_datetime),('line',int),('offset',long),('signature',long,'opt')),
         'FirstTime':(('first_time', awstats_datetime),),
         'LastTime':(('last_time',awstats_datetime),),
         'LastUpdate':(('date',awstats_datetime),('parsed',int),('old',int),('new',int),('corrupted',int),('dropped',int)),
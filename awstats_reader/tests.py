@@ -1,16 +1,60 @@
 #!/usr/bin/env python
 
+import bz2
 import datetime
+import gzip
+import json
 import os
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import threading
 import types
+import urllib2
 import unittest2 as unittest
 
 import awstats_reader
+import awstats_cache_merge
+import awstats_diff
+import awstats_server
 
 opd = os.path.dirname
 
 test_file_dir = os.path.join(opd(opd(os.path.abspath(__file__))), 'test_files')
 
+def make_temp_dir(test):
+    """Makes a temporary directory, removed when the test finishes"""
+    tmp_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmp_dir)
+    return tmp_dir
+
+def copy_test_files(dest_dir, domain=None, new_domain=None):
+    """
+    Copies the test files (only those of domain, if given) into dest_dir,
+    renaming them to new_domain if given
+    """
+    for fname in os.listdir(test_file_dir):
+        if domain is not None and not fname.endswith('.' + domain + '.txt'):
+            continue
+        dest_name = fname
+        if new_domain is not None:
+            dest_name = fname.replace(domain, new_domain)
+        shutil.copy(os.path.join(test_file_dir, fname), os.path.join(dest_dir, dest_name))
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    Gives each test a temporary directory, self.dir. If copy_files is True,
+    the test files are copied into it.
+    """
+    copy_files = False
+
+    def setUp(self):
+        self.dir = make_temp_dir(self)
+        if self.copy_files:
+            copy_test_files(self.dir)
+
 class TestAwstatsHelpers(unittest.TestCase):
     """Tests various helper functions in the awstats_reader package"""
 
@@ -60,6 +104,20 @@ class TestAwstatsHelpers(unittest.TestCase):
         obj = awstats_reader.AttrDict([('this','that'), ('thus','those')])
         self.assertEqual(obj.thus, 'those')
 
+    def test_parse_cache_name(self):
+        """Ensure the year and month are taken from cache file names"""
+        self.assertEqual(awstats_reader._parse_cache_name('/a/awstats112009.example.com.txt.gz'),
+                         (2009, 11, 'example.com'))
+        self.assertEqual(awstats_reader._parse_cache_name('/a/awstatsXX2009.example.com.txt'),
+                         (None, None, None))
+        self.assertEqual(awstats_reader._parse_cache_name('old.txt'), (None, None, None))
+
+    def test_cache_file(self):
+        """Ensure a month's cache file is found by name"""
+        self.assertEqual(awstats_reader.cache_file(test_file_dir, 'jjncj.com', 2009, 11),
+                         os.path.join(test_file_dir, 'awstats112009.jjncj.com.txt'))
+        self.assertTrue(awstats_reader.cache_file(test_file_dir, 'jjncj.com', 2009, 1) is None)
+
 class TestAwstatsReader(unittest.TestCase):
     """Tests the AwstatsReader main object"""
 
@@ -115,6 +173,445 @@ class TestAwstatsReader(unittest.TestCase):
         self.assertEqual(str(ar), '<AwstatsReader: 2008, 2009>')
 
 
+class TestAwstatsDiff(TempDirTestCase):
+    """Tests comparing two versions of a month"""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        fname = 'awstats112009.jjncj.com.txt'
+        data = open(os.path.join(test_file_dir, fname)).read()
+        # Same length replacements, so the map stays valid
+        data = data.replace('TotalVisits 1475', 'TotalVisits 1480')
+        data = data.replace('LastUpdate 20091201094510', 'LastUpdate 20091201104510')
+        open(os.path.join(self.dir, fname), 'w').write(data)
+        self.old = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com')[2009][11]
+        self.new = awstats_reader.AwstatsReader(self.dir, 'jjncj.com')[2009][11]
+
+    def test_identical(self):
+        """Ensure a month compared with itself has no differences"""
+        other = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com')[2009][11]
+        self.assertEqual(len(awstats_reader.diff_months(self.old, other)), 0)
+
+    def test_section_digest(self):
+        """Ensure section digests only differ for changed sections"""
+        self.assertNotEqual(self.old.section_digest('general'), self.new.section_digest('general'))
+        self.assertEqual(self.old.section_digest('visitor'), self.new.section_digest('visitor'))
+
+    def test_changed_rows(self):
+        """Ensure only the changed rows and fields are reported"""
+        diff = awstats_reader.diff_months(self.old, self.new)
+        self.assertEqual(diff.keys(), ['general'])
+        self.assertEqual(diff['general'].changed.keys(), ['LastUpdate', 'TotalVisits'])
+        self.assertEqual(diff['general'].changed['TotalVisits'].value, 5)
+        self.assertEqual(diff['general'].changed['LastUpdate'].date,
+                         (awstats_reader.AwstatsDateTime(2009, 12, 1, 9, 45, 10),
+                          awstats_reader.AwstatsDateTime(2009, 12, 1, 10, 45, 10)))
+
+    def test_added_removed_rows(self):
+        """Ensure added and removed rows are reported"""
+        other = awstats_reader.AwstatsReader(test_file_dir, 'joshuakugler.com')[2009][11]
+        diff = awstats_reader.diff_months(self.old, other, ['os'])
+        self.assertEqual(diff.keys(), ['os'])
+        self.assertEqual(diff['os'].added.keys(), ['linuxredhat', 'linuxcentos'])
+        self.assertEqual(diff['os'].removed.keys(), ['macintosh', 'bsdfreebsd', 'win16'])
+
+    def test_write_diff(self):
+        """Ensure the awstats_diff output lists changed fields"""
+        out = StringIO.StringIO()
+        awstats_diff.write_diff(awstats_reader.diff_months(self.old, self.new), out)
+        self.assertEqual(out.getvalue(), 'BEGIN_GENERAL\n'
+                         '~ LastUpdate date=20091201094510->20091201104510\n'
+                         '~ TotalVisits value=+5\n'
+                         'END_GENERAL\n')
+
+
+class TestAwstatsCompressed(TempDirTestCase):
+    """Tests reading compressed cache files"""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        for fname in os.listdir(test_file_dir):
+            if not fname.endswith('.jjncj.com.txt'):
+                continue
+            data = open(os.path.join(test_file_dir, fname)).read()
+            if fname.startswith('awstats11'):
+                f = gzip.GzipFile(os.path.join(self.dir, fname + '.gz'), 'w')
+            else:
+                f = bz2.BZ2File(os.path.join(self.dir, fname + '.bz2'), 'w')
+            f.write(data)
+            f.close()
+        self.ar = awstats_reader.AwstatsReader(self.dir, 'jjncj.com')
+        self.plain = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com')
+
+    def test_found_all_months(self):
+        """Ensure compressed files are found"""
+        self.assertEqual([(ary.year, ary.months) for ary in self.ar],
+                         [(2008, [11, 12]), (2009, [11, 12])])
+
+    def test_keys(self):
+        """Ensure the map of a compressed file is read"""
+        self.assertEqual(self.ar[2009][11].keys(), self.plain[2009][11].keys())
+
+    def test_gzip_sections(self):
+        """Ensure every section of a gzip file matches the uncompressed file"""
+        arm = self.ar[2009][11]
+        for section in reversed(self.plain[2009][11].keys()):
+            self.assertEqual(list(arm[section].items()),
+                             list(self.plain[2009][11][section].items()))
+
+    def test_bz2_section(self):
+        """Ensure a section of a bz2 file matches the uncompressed file"""
+        self.assertEqual(list(self.ar[2008][12]['visitor'].items()),
+                         list(self.plain[2008][12]['visitor'].items()))
+
+    def test_decompressed_once(self):
+        """Ensure reading the sections in file order decompresses the file once"""
+        opened = []
+        open_cache_file = awstats_reader._open_cache_file
+        def counting_open(fname):
+            fobject = open_cache_file(fname)
+            if fname.endswith('.gz'):
+                opened.append(fobject)
+            return fobject
+        awstats_reader._open_cache_file = counting_open
+        try:
+            arm = awstats_reader.AwstatsMonth(2009, 11, self.ar[2009][11].fname)
+            offsets = dict([(line[4:].split()[0].lower(), int(line.split()[1]))
+                            for line in open(self.plain[2009][11].fname) if line.startswith('POS_')])
+            for section in sorted(arm.keys(), key=offsets.get):
+                self.assertEqual(list(arm[section].items()),
+                                 list(self.plain[2009][11][section].items()))
+        finally:
+            awstats_reader._open_cache_file = open_cache_file
+        # Once for the map, once for the sections, and the stream is closed
+        # once it reaches the end of the file
+        self.assertEqual(len(opened), 2)
+        self.assertTrue(opened[1].fileobj is None)
+
+    def test_truncated(self):
+        """Ensure a section cut short in a compressed file raises an exception"""
+        fname = os.path.join(self.dir, 'awstats012010.jjncj.com.txt.gz')
+        f = gzip.GzipFile(fname, 'w')
+        f.write(open(self.plain[2009][11].fname).read()[:60000])
+        f.close()
+        arm = awstats_reader.AwstatsMonth(2010, 1, fname)
+        self.assertRaises(ValueError, arm.__getitem__, 'keywords')
+        self.assertRaises(ValueError, arm.__getitem__, 'plugin_geoip_city_maxmind')
+        self.assertEqual(list(arm['general'].items()), list(self.plain[2009][11]['general'].items()))
+
+    def test_plain_preferred(self):
+        """Ensure an uncompressed file wins over a compressed one"""
+        shutil.copy(os.path.join(test_file_dir, 'awstats112009.jjncj.com.txt'), self.dir)
+        files = awstats_reader.cache_files(self.dir, 'jjncj.com')
+        self.assertEqual(os.path.basename(files[(2009, 11)]), 'awstats112009.jjncj.com.txt')
+
+
+class TestAwstatsRollup(TempDirTestCase):
+    """Tests yearly and all time rollups"""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.ar = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com', self.dir)
+
+    def test_year_rollup(self):
+        """Ensure a year's rollup holds the merged months"""
+        rollup = self.ar[2009].rollup
+        self.assertEqual(str(rollup), '<AwstatsRollup 2009>')
+        self.assertEqual(rollup['general']['TotalVisits'].value,
+                         sum([m['general']['TotalVisits'].value for m in self.ar[2009]]))
+        self.assertEqual(len(rollup['day']),
+                         sum([len(m['day']) for m in self.ar[2009]]))
+
+    def test_all_time_rollup(self):
+        """Ensure the all time rollup holds every month"""
+        rollup = self.ar.rollup
+        self.assertEqual(str(rollup), '<AwstatsRollup all>')
+        self.assertEqual(rollup.general.TotalVisits.value,
+                         sum([m.general.TotalVisits.value for ary in self.ar for m in ary]))
+
+    def test_rollup_read_only(self):
+        """Ensure reading a rollup writes nothing, and uses the file once it's built"""
+        in_memory = self.ar[2009].rollup
+        self.assertEqual(os.listdir(self.dir), [])
+        self.ar.rollup
+        self.assertEqual(os.listdir(self.dir), [])
+
+        self.ar.build_rollups()
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+        rollup = self.ar[2009].rollup
+        self.assertEqual(list(rollup['day'].items()), list(in_memory['day'].items()))
+        self.assertEqual(rollup.general.TotalVisits.value, in_memory.general.TotalVisits.value)
+        self.assertEqual(self.ar.rollup.general.TotalVisits.value,
+                         sum([m.general.TotalVisits.value for ary in self.ar for m in ary]))
+
+    def test_rollup_incremental(self):
+        """Ensure only years with changed months are rebuilt"""
+        self.assertEqual(self.ar.build_rollups(), [2008, 2009])
+        self.assertEqual(self.ar.build_rollups(), [])
+        fname = self.ar[2009][11].fname
+        st = os.stat(fname)
+        os.utime(fname, (st.st_atime, st.st_mtime + 10))
+        try:
+            self.assertEqual(self.ar.build_rollups(), [2009])
+        finally:
+            os.utime(fname, (st.st_atime, st.st_mtime))
+
+    def test_merged_file_readable(self):
+        """Ensure files written by write_cache_file can be read back"""
+        fname = os.path.join(self.dir, 'awstats112009.example.com.txt')
+        m = self.ar[2009][11]
+        awstats_reader.write_cache_file(fname, awstats_reader.month_data(m), m.version)
+        m2 = awstats_reader.AwstatsReader(self.dir, 'example.com')[2009][11]
+        self.assertEqual(m2.keys(), m.keys())
+        self.assertEqual(list(m2['sider_404'].items()), list(m['sider_404'].items()))
+
+
+class TestUniqueVisitors(TempDirTestCase):
+    """Tests the HyperLogLog unique visitor sketches"""
+    copy_files = True
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.ar = awstats_reader.AwstatsReader(self.dir, 'jjncj.com')
+
+    def test_estimate(self):
+        """Ensure the estimate is within 3% of the true count"""
+        h = awstats_reader.HyperLogLog()
+        for i in xrange(10000):
+            h.add(str(i))
+        self.assertTrue(abs(h.estimate() - 10000) < 300)
+
+    def test_merge(self):
+        """Ensure merged sketches count the union of their keys"""
+        h1 = awstats_reader.HyperLogLog()
+        h2 = awstats_reader.HyperLogLog()
+        for i in xrange(1000):
+            h1.add(str(i))
+            h2.add(str(i + 500))
+        self.assertTrue(abs(h1.merge(h2).estimate() - 1500) < 45)
+
+    def test_merge_precision_mismatch(self):
+        """Ensure sketches of different precisions can't be merged"""
+        self.assertRaises(ValueError, awstats_reader.HyperLogLog().merge,
+                          awstats_reader.HyperLogLog(12))
+
+    def test_month_sketch(self):
+        """Ensure a month's sketch matches TotalUnique, and isn't saved without a sketch_dir"""
+        m = self.ar[2009][11]
+        self.assertTrue(abs(m.unique_sketch().estimate() - m.general.TotalUnique.value) < 10)
+        self.ar.unique_visitors()
+        self.assertEqual([f for f in os.listdir(self.dir) if f.endswith('.hll')], [])
+
+    def test_sketch_dir(self):
+        """Ensure sketches are saved in the sketch_dir, and used from there"""
+        sketch_dir = make_temp_dir(self)
+        ar = awstats_reader.AwstatsReader(self.dir, 'jjncj.com', sketch_dir=sketch_dir)
+        estimate = ar.unique_visitors()
+        self.assertEqual(len(os.listdir(sketch_dir)), 4)
+        m = ar[2009][11]
+        signature, sketch = awstats_reader.HyperLogLog.load(
+            os.path.join(sketch_dir, os.path.basename(m.fname) + '.hll'))
+        self.assertEqual(sketch.registers, m.unique_sketch().registers)
+        self.assertEqual(ar.unique_visitors(), estimate)
+
+    def test_date_range(self):
+        """Ensure a date range only counts its months"""
+        m = self.ar[2009][11]
+        self.assertEqual(self.ar.unique_visitors((2009, 11), (2009, 11)),
+                         m.unique_sketch().estimate())
+        self.assertEqual(self.ar.unique_visitors((2010, 1)), 0)
+
+    def test_merged_total_unique(self):
+        """Ensure merging months doesn't count shared visitors twice"""
+        m1 = self.ar[2009][11]
+        m2 = awstats_reader.AwstatsReader(self.dir, 'joshuakugler.com')[2009][11]
+        data = awstats_cache_merge.merge_month(m1, m2)
+        hosts = set([h for h in m1.visitor if m1.visitor[h].pages > 0] +
+                    [h for h in m2.visitor if m2.visitor[h].pages > 0])
+        self.assertEqual(data['general']['TotalUnique'].value, len(hosts))
+
+
+class TestBatchQuery(unittest.TestCase):
+    """Tests running a query against many domains"""
+
+    selectors = [('general', 'TotalVisits', 'value'), ('day', None, 'bandwidth'),
+                 ('general', 'NoSuchRow', 'value'), ('nosuchsection', None, 'hits'),
+                 ('day', None, 'nosuchfield')]
+
+    def test_serial(self):
+        """Ensure the right values are returned for each month"""
+        results = list(awstats_reader.batch_query(test_file_dir, ['jjncj.com', 'joshuakugler.com'],
+                                                  self.selectors, processes=1))
+        self.assertEqual(len(results), 8)
+        m = awstats_reader.AwstatsReader(test_file_dir, 'joshuakugler.com')[2009][11]
+        wanted = [m.general.TotalVisits.value, sum([m.day[d].bandwidth for d in m.day]),
+                  None, None, None]
+        self.assertTrue(('joshuakugler.com', 2009, 11, wanted, None) in results)
+
+    def test_unreadable_file(self):
+        """Ensure a file which can't be read is reported without stopping the batch"""
+        tmp_dir = make_temp_dir(self)
+        copy_test_files(tmp_dir, 'jjncj.com')
+        bad = os.path.join(tmp_dir, 'awstats112009.jjncj.com.txt')
+        text = open(bad).read()
+        open(bad, 'w').write(text[:60000])
+        for processes in (1, 2):
+            results = list(awstats_reader.batch_query(tmp_dir, ['jjncj.com'],
+                                                      [('keywords', None, 'value')],
+                                                      processes=processes))
+            self.assertEqual(len(results), 4)
+            errors = [r for r in results if r[4] is not None]
+            self.assertEqual([r[:4] for r in errors], [('jjncj.com', 2009, 11, None)])
+            self.assertTrue('truncated' in errors[0][4])
+
+    def test_sum_not_numeric(self):
+        """Ensure summing a text field gives None rather than an error"""
+        results = list(awstats_reader.batch_query(test_file_dir, ['jjncj.com'],
+                                                  [('sider_404', None, 'last_url_referer')],
+                                                  (2009, 11), (2009, 11), processes=1))
+        self.assertEqual(results, [('jjncj.com', 2009, 11, [None], None)])
+
+    def test_bad_date(self):
+        """Ensure a file with a bad date is reported without stopping the batch"""
+        tmp_dir = make_temp_dir(self)
+        copy_test_files(tmp_dir, 'jjncj.com')
+        bad = os.path.join(tmp_dir, 'awstats112009.jjncj.com.txt')
+        text = open(bad).read()
+        # Same length, so the map's offsets still hold
+        open(bad, 'w').write(text.replace('acsalaska.net 1286 1286 522852 20091130234113',
+                                          'acsalaska.ne 1286 1286 522852 200911302341130'))
+        results = list(awstats_reader.batch_query(tmp_dir, ['jjncj.com'],
+                                                  [('visitor', None, 'pages')], processes=1))
+        self.assertEqual(len(results), 4)
+        errors = [r for r in results if r[4] is not None]
+        self.assertEqual([r[:4] for r in errors], [('jjncj.com', 2009, 11, None)])
+        self.assertTrue('Invalid date' in errors[0][4])
+
+    def test_date_range(self):
+        """Ensure only months in the date range are queried"""
+        results = awstats_reader.batch_query(test_file_dir, ['jjncj.com'], self.selectors,
+                                             (2008, 12), (2009, 11), processes=1)
+        self.assertEqual(sorted([(r[1], r[2]) for r in results]), [(2008, 12), (2009, 11)])
+
+    def test_process_pool(self):
+        """Ensure a process pool returns the same results as running serially"""
+        domains = ['jjncj.com', 'joshuakugler.com']
+        serial = awstats_reader.batch_query(test_file_dir, domains, self.selectors, processes=1)
+        pooled = awstats_reader.batch_query(test_file_dir, domains, self.selectors, processes=2)
+        self.assertEqual(sorted(pooled), sorted(serial))
+
+
+class TestProbe(unittest.TestCase):
+    """Tests reading just the head of cache files"""
+
+    def setUp(self):
+        self.fname = os.path.join(test_file_dir, 'awstats112009.jjncj.com.txt')
+        self.m = awstats_reader.AwstatsMonth(2009, 11, self.fname)
+
+    def test_probe(self):
+        """Ensure a probe finds the version, sections and general section"""
+        p = awstats_reader.probe(self.fname)
+        self.assertEqual((p.year, p.month, p.version), (2009, 11, ('6.7', '1.892')))
+        self.assertEqual(p.sections, TestAwstatsMonth.wanted_sections)
+        self.assertEqual(list(p.general.items()), list(self.m.general.items()))
+        self.assertEqual(p.general.TotalVisits.value, 1475)
+        self.assertTrue(p.error is None)
+
+    def test_probe_small_reads(self):
+        """Ensure a probe works when the map or general section don't fit the first read"""
+        for size in (256, 512, 2000):
+            p = awstats_reader.probe(self.fname, size)
+            self.assertEqual(p.sections, TestAwstatsMonth.wanted_sections)
+            self.assertEqual(list(p.general.items()), list(self.m.general.items()))
+
+    def test_probe_compressed(self):
+        """Ensure compressed files can be probed"""
+        fname = os.path.join(make_temp_dir(self), 'awstats112009.jjncj.com.txt.gz')
+        f = gzip.GzipFile(fname, 'w')
+        f.write(open(self.fname).read())
+        f.close()
+        p = awstats_reader.probe(fname)
+        self.assertEqual(list(p.general.items()), list(self.m.general.items()))
+
+    def test_probe_bad_files(self):
+        """Ensure files which can't be probed are reported without stopping the sweep"""
+        tmp_dir = make_temp_dir(self)
+        copy_test_files(tmp_dir, 'jjncj.com')
+        open(os.path.join(tmp_dir, 'awstats012010.jjncj.com.txt'), 'w').close()
+        open(os.path.join(tmp_dir, 'awstats022010.jjncj.com.txt'), 'w').write('Not a cache file\n')
+        fnames = sorted(awstats_reader.cache_files(tmp_dir, 'jjncj.com').values())
+        for processes in (1, 2):
+            results = list(awstats_reader.probe_files(fnames, processes))
+            self.assertEqual(len(results), 6)
+            bad = sorted([(p.year, p.month) for p in results if p.error is not None])
+            self.assertEqual(bad, [(2010, 1), (2010, 2)])
+            for p in results:
+                if p.error is None:
+                    self.assertEqual(p.sections, TestAwstatsMonth.wanted_sections)
+                else:
+                    self.assertTrue(p.general is None)
+
+    def test_reader_probe(self):
+        """Ensure AwstatsReader.probe covers every month, in order"""
+        ar = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com')
+        self.assertEqual([(p.year, p.month) for p in ar.probe(processes=1)],
+                         [(2008, 11), (2008, 12), (2009, 11), (2009, 12)])
+        self.assertEqual([p.general.LastUpdate.date for p in ar.probe(processes=2)],
+                         [m.general.LastUpdate.date for ary in ar for m in ary])
+
+
+class TestInternPool(unittest.TestCase):
+    """Tests sharing strings between months"""
+
+    def test_intern(self):
+        """Ensure equal strings come back as the same object"""
+        pool = awstats_reader.InternPool()
+        s1 = ''.join(['fire', 'fox'])
+        s2 = ''.join(['fire', 'fox'])
+        self.assertTrue(pool.intern(s1) is s1)
+        self.assertTrue(pool.intern(s2) is s1)
+        stats = pool.stats()
+        self.assertEqual((stats['strings'], stats['hits'], stats['duplicate_bytes']),
+                         (1, 1, sys.getsizeof(s2)))
+        self.assertEqual(stats['pool_bytes'], sys.getsizeof({s1:s1}) + sys.getsizeof(s1))
+        self.assertEqual(stats['saved_bytes'], stats['duplicate_bytes'] - stats['pool_bytes'])
+
+    def test_bounded(self):
+        """Ensure a bounded pool stops taking new strings"""
+        pool = awstats_reader.InternPool(1)
+        pool.intern('firefox')
+        s = ''.join(['ms', 'ie'])
+        self.assertTrue(pool.intern(s) is s)
+        self.assertEqual(len(pool), 1)
+        self.assertFalse('msie' in pool)
+
+    def test_shared_between_months(self):
+        """Ensure row names are shared between months read by a reader given a pool"""
+        ar = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com',
+                                          intern_pool=awstats_reader.InternPool())
+        k1 = [k for k in ar[2009][11]['browser'] if k == 'msie6.0'][0]
+        k2 = [k for k in ar[2009][12]['browser'] if k == 'msie6.0'][0]
+        self.assertTrue(k1 is k2)
+        self.assertTrue(ar.intern_pool.hits > 0)
+
+    def test_only_str_fields(self):
+        """Ensure only row names and str fields are interned"""
+        pool = awstats_reader.InternPool()
+        m = awstats_reader.AwstatsMonth(2009, 11, os.path.join(test_file_dir,
+                                        'awstats112009.jjncj.com.txt'), pool)
+        for url, (hits, referer) in m['sider_404'].items():
+            self.assertTrue(url in pool)
+            self.assertTrue(referer in pool)
+        for host, fields in m['visitor'].items():
+            self.assertTrue(host in pool)
+            self.assertFalse([f for f in fields if f in pool])
+
+    def test_off_by_default(self):
+        """Ensure a reader doesn't intern without a pool"""
+        ar = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com')
+        self.assertTrue(ar.intern_pool is None)
+
+
 class TestAwstatsYear(unittest.TestCase):
 
     def setUp(self):
@@ -199,6 +696,48 @@ class TestAwstatsMonth(unittest.TestCase):
         arm = self.ar[2009][11]
         self.assertEqual(str(arm), '<AwstatsMonth 2009-11>')
 
+    def test_threaded_sections(self):
+        """Ensure threads loading sections of the same month don't interfere"""
+        wanted = {}
+        for section in self.__class__.wanted_sections:
+            wanted[section] = list(self.ar[2009][11][section].items())
+
+        arm = awstats_reader.AwstatsReader(test_file_dir, 'jjncj.com')[2009][11]
+        results = {}
+        def load(section):
+            results[section] = list(arm[section].items())
+        threads = [threading.Thread(target=load, args=(section,))
+                   for section in self.__class__.wanted_sections]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, wanted)
+
+    def test_file_replaced(self):
+        """Ensure a month whose file is replaced by a rename reads the new file"""
+        tmp_dir = make_temp_dir(self)
+        fname = os.path.join(tmp_dir, 'awstats112009.jjncj.com.txt')
+        shutil.copy(self.ar[2009][11].fname, fname)
+        arm = awstats_reader.AwstatsMonth(2009, 11, fname)
+        self.assertEqual(arm.keys(), self.__class__.wanted_sections)
+        old_general = list(arm['general'].items())
+
+        new_name = os.path.join(tmp_dir, 'new.txt')
+        shutil.copy(self.ar[2009][12].fname, new_name)
+        os.rename(new_name, fname)
+        self.assertEqual(list(arm['os'].items()), list(self.ar[2009][12]['os'].items()))
+        self.assertEqual(list(arm['general'].items()), list(self.ar[2009][12]['general'].items()))
+        self.assertNotEqual(list(arm['general'].items()), old_general)
+
+    def test_truncated_file(self):
+        """Ensure a section cut short by a truncated file raises an exception"""
+        fname = os.path.join(make_temp_dir(self), 'awstats112009.jjncj.com.txt')
+        open(fname, 'w').write(open(self.ar[2009][11].fname).read()[:60000])
+        arm = awstats_reader.AwstatsMonth(2009, 11, fname)
+        self.assertRaises(ValueError, arm.__getitem__, 'keywords')
+        self.assertRaises(ValueError, list, arm.raw_rows('keywords'))
+
 class TestAwstatsSection(unittest.TestCase):
     wanted_lines = ['LastLine', 'FirstTime', 'LastTime', 'LastUpdate',
                     'TotalVisits', 'TotalUnique', 'MonthHostsKnown',
@@ -285,6 +824,53 @@ class TestAwstatsSection(unittest.TestCase):
         self.assertEqual(ars.merge(ars2, '/styles/widgets/blog-widget.css',
                                    'last_url_referer'), 'http://joshuakugler.com/')
 
+    def test_merge_section(self):
+        """Ensure merge_section agrees with merge for every row and field"""
+        ars = self.ar[2009][11]['general']
+        ars2 = awstats_reader.AwstatsReader(test_file_dir,
+                                            'joshuakugler.com')[2009][11]['general']
+        merged = ars.merge_section(ars2)
+        for row_name in ars:
+            for field in ars[row_name]:
+                self.assertEqual(merged[row_name][field], ars.merge(ars2, row_name, field))
+
+    def test_merge_section_rows(self):
+        """Ensure merge_section keeps rows found in only one section, in order"""
+        ars = self.ar[2009][11]['browser']
+        ars2 = awstats_reader.AwstatsReader(test_file_dir,
+                                            'joshuakugler.com')[2009][11]['browser']
+        merged = ars.merge_section(ars2)
+        wanted = ars.keys() + [k for k in ars2 if k not in ars.keys()]
+        self.assertEqual(merged.keys(), wanted)
+
+    def test_merge_section_one_sided_rows(self):
+        """Ensure rows found in only one section read like the rows they came from"""
+        ars = self.ar[2009][11]['browser']
+        ars2 = awstats_reader.AwstatsReader(test_file_dir,
+                                            'joshuakugler.com')[2009][11]['browser']
+        merged = ars.merge_section(ars2)
+        only1 = [k for k in ars if k not in ars2.keys()]
+        only2 = [k for k in ars2 if k not in ars.keys()]
+        self.assertTrue(only1 and only2)
+        for section, row_name in [(ars, only1[0]), (ars2, only2[0])]:
+            row = merged[row_name]
+            self.assertEqual(row, section[row_name])
+            self.assertEqual(list(row.items()), list(section[row_name].items()))
+            self.assertEqual(list(row), list(section[row_name]))
+            self.assertEqual(row.value, section[row_name].value)
+            self.assertEqual(row['value'], section[row_name]['value'])
+            self.assertTrue(row.get('nosuchfield') is None)
+            self.assertRaises(KeyError, lambda: row['nosuchfield'])
+
+    def test_merge_data_one_sided_rows(self):
+        """Ensure merge_data uses rows found on only one side as they are"""
+        data1 = awstats_reader.month_data(self.ar[2009][11])
+        data2 = awstats_reader.month_data(awstats_reader.AwstatsReader(test_file_dir,
+                                                                       'joshuakugler.com')[2009][11])
+        merged = awstats_reader.merge_data(data1, data2)
+        row_name = [k for k in data2['browser'] if k not in data1['browser']][0]
+        self.assertTrue(merged['browser'][row_name] is data2['browser'][row_name])
+
     def test_str_function(self):
         """Test the 'str' function"""
         ars = self.ar[2009][11]['general']
@@ -307,3 +893,341 @@ class TestAwstatsMerge(unittest.TestCase):
         f = awstats_reader.make_get_field('bandwidth')
 
         self.assertEqual(f(('dz', od)), 386873)
+
+class TestAwstatsCacheMerge(TempDirTestCase):
+    """Test the watch mode support in awstats_cache_merge"""
+    copy_files = True
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.sources = ((self.dir, 'jjncj.com'), (self.dir, 'joshuakugler.com'))
+
+    def rewrite(self, fname, old, new):
+        fname = os.path.join(self.dir, fname)
+        data = open(fname).read().replace(old, new)
+        open(fname, 'w').write(data)
+        st = os.stat(fname)
+        os.utime(fname, (st.st_atime, st.st_mtime + 10))
+
+    def test_poll_initial(self):
+        """Ensure the first poll reports every month"""
+        self.assertEqual(awstats_cache_merge.poll_sources(self.sources, {}),
+                         set([(2008, 11), (2008, 12), (2009, 11), (2009, 12)]))
+
+    def test_poll_unchanged(self):
+        """Ensure a second poll with no changes reports nothing"""
+        state = {}
+        awstats_cache_merge.poll_sources(self.sources, state)
+        self.assertEqual(awstats_cache_merge.poll_sources(self.sources, state), set())
+
+    def test_poll_last_update_changed(self):
+        """Ensure only the month with a new LastUpdate is reported"""
+        state = {}
+        awstats_cache_merge.poll_sources(self.sources, state)
+        self.rewrite('awstats112009.jjncj.com.txt', 'LastUpdate 20091201094510',
+                     'LastUpdate 20091201104510')
+        self.assertEqual(awstats_cache_merge.poll_sources(self.sources, state),
+                         set([(2009, 11)]))
+
+    def test_poll_touched_only(self):
+        """Ensure a file touched without a new LastUpdate is not reported"""
+        state = {}
+        awstats_cache_merge.poll_sources(self.sources, state)
+        self.rewrite('awstats112009.jjncj.com.txt', 'TotalVisits 1475', 'TotalVisits 1476')
+        self.assertEqual(awstats_cache_merge.poll_sources(self.sources, state), set())
+
+    def test_poll_unreadable(self):
+        """Ensure a file which can't be read is skipped, and tried again next time"""
+        self.rewrite('awstats112009.jjncj.com.txt', 'BEGIN_GENERAL', 'BEGIN_GENERAL x')
+        state = {}
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            awstats_cache_merge.poll_sources(self.sources, state)
+        finally:
+            sys.stderr = stderr
+        self.assertFalse(os.path.join(self.dir, 'awstats112009.jjncj.com.txt') in state)
+        self.assertEqual(len(state), 7)
+
+    def test_failed_merge_retried(self):
+        """Ensure a month which fails to merge is merged again on the next poll"""
+        outdir = os.path.join(self.dir, 'out')
+        class Opts(object):
+            verbose = 0
+            outdomain = 'example.com'
+        opts = Opts()
+        opts.outdir = outdir
+        state = {}
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            # The output directory doesn't exist yet, so every month fails
+            failed = awstats_cache_merge.merge_changed(opts, self.sources, state)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(failed, [(2008, 11), (2008, 12), (2009, 11), (2009, 12)])
+        self.assertEqual(state, {})
+
+        os.mkdir(outdir)
+        self.assertEqual(awstats_cache_merge.merge_changed(opts, self.sources, state), [])
+        self.assertEqual(len([f for f in os.listdir(outdir) if f.endswith('.txt')]), 4)
+
+    def test_source_is_output(self):
+        """Ensure no source, including --source ones, can be the output"""
+        outdir = os.path.join(self.dir, 'out')
+        argv, stderr = sys.argv, sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            for args in (['--dir2', outdir, '--domain2', 'jjncj.com'],
+                         ['--source', outdir + ':jjncj.com']):
+                sys.argv = ['awstats_cache_merge.py', '--dir1', self.dir, '--domain1', 'jjncj.com',
+                            '--domain2', 'joshuakugler.com', '--outdir', outdir] + args
+                self.assertRaises(SystemExit, awstats_cache_merge.get_opts)
+            sys.argv = sys.argv[:-2] + ['--source', outdir + ':other.com']
+            opts, args = awstats_cache_merge.get_opts()
+            self.assertEqual(opts.sources, [outdir + ':other.com'])
+        finally:
+            sys.argv, sys.stderr = argv, stderr
+
+    def test_write_file_atomic(self):
+        """Ensure write_file leaves only the finished file behind"""
+        outdir = os.path.join(self.dir, 'out')
+        os.mkdir(outdir)
+        m = awstats_reader.AwstatsReader(self.dir, 'jjncj.com')[2009][12]
+        awstats_cache_merge.write_file(outdir, 'example.com', 2009, 12,
+                                       awstats_cache_merge.month_data(m), m.version)
+        self.assertEqual(os.listdir(outdir), ['awstats122009.example.com.txt'])
+
+class TestAwstatsServer(unittest.TestCase):
+    """Test the JSON server in awstats_server"""
+
+    def setUp(self):
+        self.server = awstats_server.AwstatsServer(('127.0.0.1', 0), test_file_dir)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def get(self, path, headers={}):
+        return urllib2.urlopen(urllib2.Request(self.base + path, headers=headers))
+
+    def test_domains(self):
+        """Ensure the domains are listed"""
+        self.assertEqual(json.load(self.get('/')), ['jjncj.com', 'joshuakugler.com'])
+
+    def test_years_and_months(self):
+        """Ensure years and months are listed"""
+        self.assertEqual(json.load(self.get('/jjncj.com')), [2008, 2009])
+        self.assertEqual(json.load(self.get('/jjncj.com/2009/')), [11, 12])
+
+    def test_sections(self):
+        """Ensure the sections of a month are listed"""
+        self.assertEqual(json.load(self.get('/jjncj.com/2009/11')),
+                         TestAwstatsMonth.wanted_sections)
+
+    def test_section_streamed(self):
+        """Ensure a large section is sent chunked, and decodes to every row"""
+        resp = self.get('/jjncj.com/2009/11/visitor')
+        self.assertEqual(resp.info()['Transfer-Encoding'], 'chunked')
+        self.assertEqual(len(json.load(resp)), 593)
+
+    def test_row(self):
+        """Ensure a single row is returned, with dates in AWStats format"""
+        self.assertEqual(json.load(self.get('/jjncj.com/2009/11/general/LastUpdate')),
+                         {'date':'20091201094510', 'parsed':1011585, 'old':0,
+                          'new':886950, 'corrupted':70062, 'dropped':54572})
+
+    def test_row_with_slashes(self):
+        """Ensure row names containing slashes are found"""
+        self.assertEqual(json.load(self.get('/jjncj.com/2009/11/sider_404//styles/widgets/blog-widget.css'))['hits'], 61)
+
+    def test_not_found(self):
+        """Ensure missing data returns a 404"""
+        try:
+            self.get('/jjncj.com/2009/1/general')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail('No 404 returned') # pragma: no cover
+
+    def test_not_modified(self):
+        """Ensure a matching If-None-Match returns a 304"""
+        etag = self.get('/jjncj.com/2009/11/general').info()['ETag']
+        try:
+            self.get('/jjncj.com/2009/11/general', {'If-None-Match':etag})
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 304)
+        else:
+            self.fail('No 304 returned') # pragma: no cover
+
+    def test_not_modified_missing(self):
+        """Ensure a missing section or row is a 404, even with a matching If-None-Match"""
+        etag = self.get('/jjncj.com/2009/11').info()['ETag']
+        for path in ('/jjncj.com/2009/11/nosuchsection', '/jjncj.com/2009/11/general/NoSuchRow'):
+            try:
+                self.get(path, {'If-None-Match':etag})
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 404)
+            else:
+                self.fail('No 404 returned') # pragma: no cover
+
+    def test_month_cache_bounded(self):
+        """Ensure the month cache drops the least recently used months"""
+        months = awstats_server.MonthCache(test_file_dir, 2)
+        m1 = months.get('jjncj.com', 2009, 11)
+        months.get('jjncj.com', 2009, 12)
+        self.assertTrue(months.get('jjncj.com', 2009, 11) is m1)
+        months.get('jjncj.com', 2008, 11)
+        self.assertEqual(len(months), 2)
+        self.assertTrue(months.get('jjncj.com', 2009, 11) is m1)
+        self.assertFalse(months.get('jjncj.com', 2009, 12) is None)
+        self.assertEqual(len(months), 2)
+
+    def test_error_while_streaming(self):
+        """Ensure an error part way through a section cuts the response short"""
+        tmp_dir = make_temp_dir(self)
+        fname = os.path.join(tmp_dir, 'awstats112009.jjncj.com.txt')
+        lines = open(os.path.join(test_file_dir, 'awstats112009.jjncj.com.txt')).readlines()
+        row = lines.index('BEGIN_VISITOR 593\n') + awstats_server.ROWS_PER_CHUNK + 10
+        host, fields = lines[row].split(' ', 1)
+        lines[row] = host + ' x' + fields[fields.index(' '):]
+        open(fname, 'w').write(''.join(lines))
+
+        self.server.months = awstats_server.MonthCache(tmp_dir)
+        sock = socket.create_connection(self.server.server_address, 5)
+        sock.sendall('GET /jjncj.com/2009/11/visitor HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        chunks = []
+        try:
+            for chunk in iter(lambda: sock.recv(65536), ''):
+                chunks.append(chunk)
+        except socket.timeout: # pragma: no cover
+            pass # The server kept the connection open
+        sock.close()
+        resp = ''.join(chunks)
+        self.assertTrue(resp.startswith('HTTP/1.1 200'))
+        self.assertEqual(resp.count('HTTP/1.1'), 1)
+        self.assertFalse(resp.endswith('0\r\n\r\n'))
+
+    def test_month_cache_invalidated(self):
+        """Ensure a cached month is dropped when its file changes"""
+        tmp_dir = make_temp_dir(self)
+        copy_test_files(tmp_dir, 'jjncj.com')
+        months = awstats_server.MonthCache(tmp_dir)
+        m = months.get('jjncj.com', 2009, 12)
+        self.assertTrue(months.get('jjncj.com', 2009, 12) is m)
+        fname = os.path.join(tmp_dir, 'awstats122009.jjncj.com.txt')
+        st = os.stat(fname)
+        os.utime(fname, (st.st_atime, st.st_mtime + 10))
+        self.assertFalse(months.get('jjncj.com', 2009, 12) is m)
+
+class TestShardedMerge(TempDirTestCase):
+    """Test the manifest, worker and reduce steps of awstats_cache_merge"""
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # Two nodes, each with a cache directory for the same domain
+        self.nodes = []
+        for node, domain in (('node1', 'jjncj.com'), ('node2', 'joshuakugler.com')):
+            self.nodes.append(self.add_node(node, domain))
+        self.outdir = os.path.join(self.dir, 'out')
+        os.mkdir(self.outdir)
+
+        class Opts(object):
+            dir1, dir2 = self.nodes
+            domain1 = domain2 = outdomain = 'example.com'
+            outdir = self.outdir
+            sources = []
+        self.opts = Opts()
+        self.manifest_name = os.path.join(self.dir, 'manifest.json')
+
+    def add_node(self, node, domain):
+        node_dir = os.path.join(self.dir, node)
+        os.mkdir(node_dir)
+        copy_test_files(node_dir, domain, 'example.com')
+        return node_dir
+
+    def test_manifest(self):
+        """Ensure the manifest has a unit per month, with every node's file"""
+        awstats_cache_merge.write_manifest(self.manifest_name, self.opts)
+        manifest = awstats_cache_merge.read_manifest(self.manifest_name)
+        self.assertEqual([(u['year'], u['month'], len(u['sources'])) for u in manifest['units']],
+                         [(2008, 11, 2), (2008, 12, 2), (2009, 11, 2), (2009, 12, 2)])
+
+    def test_merge_writes_only_outdir(self):
+        """Ensure merging writes nothing into the source directories"""
+        before = [sorted(os.listdir(node_dir)) for node_dir in self.nodes]
+        awstats_cache_merge.merge_all(self.opts)
+        self.assertEqual([sorted(os.listdir(node_dir)) for node_dir in self.nodes], before)
+        self.assertEqual(len([f for f in os.listdir(self.outdir) if f.endswith('.hll')]), 4)
+
+    def test_shards(self):
+        """Ensure shards merged separately and reduced match a single merge"""
+        manifest = awstats_cache_merge.write_manifest(self.manifest_name, self.opts)
+        self.assertEqual(len(awstats_cache_merge.run_worker(manifest, 0, 3)), 2)
+        self.assertEqual(len(awstats_cache_merge.run_worker(manifest, 1, 3)), 1)
+        self.assertEqual(len(awstats_cache_merge.run_worker(manifest, 2, 3)), 1)
+        self.assertEqual(awstats_cache_merge.run_reduce(manifest), [])
+        self.assertFalse(os.path.exists(awstats_cache_merge.staging_dir(manifest)))
+
+        single_dir = os.path.join(self.dir, 'single')
+        os.mkdir(single_dir)
+        self.opts.outdir = single_dir
+        awstats_cache_merge.merge_all(self.opts)
+        self.assertEqual(sorted(os.listdir(self.outdir)), sorted(os.listdir(single_dir)))
+        for fname in os.listdir(single_dir):
+            if fname.endswith('.txt'):
+                self.assertEqual(open(os.path.join(self.outdir, fname)).read(),
+                                 open(os.path.join(single_dir, fname)).read())
+
+    def test_reduce_missing_shard(self):
+        """Ensure reduce refuses to assemble an incomplete merge"""
+        manifest = awstats_cache_merge.write_manifest(self.manifest_name, self.opts)
+        awstats_cache_merge.run_worker(manifest, 0, 2)
+        self.assertEqual(len(awstats_cache_merge.run_reduce(manifest)), 2)
+        self.assertEqual(os.listdir(self.outdir), [os.path.basename(awstats_cache_merge.staging_dir(manifest))])
+
+    def test_reduce_missing_source(self):
+        """Ensure reduce reports a missing source instead of failing"""
+        manifest = awstats_cache_merge.write_manifest(self.manifest_name, self.opts)
+        awstats_cache_merge.run_worker(manifest, 0, 1)
+        os.unlink(manifest['units'][0]['sources'][0])
+        problems = awstats_cache_merge.run_reduce(manifest)
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith('A source of'))
+
+    def test_extra_source(self):
+        """Ensure --source adds a further node to merge"""
+        self.opts.dir2 = self.opts.dir1
+        self.opts.domain2 = 'other.com'
+        self.opts.sources = [self.nodes[1] + ':example.com']
+        units = awstats_cache_merge.find_units(awstats_cache_merge.get_sources(self.opts))
+        self.assertEqual([len(fnames) for year, month, fnames in units], [2, 2, 2, 2])
+
+    def test_three_sources(self):
+        """Ensure a merge of three sources holds the data of all three"""
+        node3 = self.add_node('node3', 'jjncj.com')
+        self.opts.sources = [node3 + ':example.com']
+        awstats_cache_merge.merge_all(self.opts)
+
+        readers = [awstats_reader.AwstatsReader(node_dir, 'example.com')
+                   for node_dir in self.nodes + [node3]]
+        merged = awstats_reader.AwstatsReader(self.outdir, 'example.com')
+        self.assertEqual([(ary.year, ary.months) for ary in merged], [(2008, [11, 12]), (2009, [11, 12])])
+        for ary in merged:
+            for m in ary:
+                months = [ar[m.year][m.month] for ar in readers]
+                self.assertEqual(m.general.TotalVisits.value,
+                                 sum([x.general.TotalVisits.value for x in months]))
+                self.assertEqual(m.general.LastUpdate.date,
+                                 max([x.general.LastUpdate.date for x in months]))
+                for day in m.day:
+                    self.assertEqual(m.day[day].bandwidth,
+                                     sum([x.day[day].bandwidth for x in months if day in x.day.keys()]))
+                hosts = set()
+                for x in months:
+                    hosts.update(x.visitor)
+                self.assertEqual(set(m.visitor), hosts)
+                self.assertEqual(m.general.TotalUnique.value,
+                                 len([h for h in m.visitor if m.visitor[h].pages > 0]))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+A small local HTTP server exposing AWStats cache files as JSON.
+
+    /                                          domains
+    /<domain>                                  years
+    /<domain>/<year>                           months
+    /<domain>/<year>/<month>                   sections
+    /<domain>/<year>/<month>/<section>         rows (sent chunked)
+    /<domain>/<year>/<month>/<section>/<row>   a single row
+
+Parsed months are kept in memory until their file changes, up to a limit,
+beyond which the least recently used are dropped. Month level responses
+carry an ETag built from general.LastUpdate, and honour If-None-Match.
+"""
+
+import BaseHTTPServer
+import glob
+import json
+import optparse
+import os
+import SocketServer
+import threading
+import urllib
+
+from awstats_reader import (AwstatsMonth, AwstatsDateTime, AwstatsDate,
+                            cache_file, cache_files, format_value,
+                            _parse_cache_name)
+from odict import OrderedDict as od
+
+__version__ = '0.1'
+
+# Number of rows sent in each chunk when streaming a section
+ROWS_PER_CHUNK = 500
+
+def get_opts():
+
+    usage = 'usage: %prog --dir=/path/to/cache/files [other options]'
+    parser = optparse.OptionParser(usage=usage, version='%prog ' + __version__)
+    a = parser.add_option
+    a('-v', action='count', dest='verbose', help='Verbose. Log every request')
+    a('--dir', dest='dir', default='.', help='Directory of cache files')
+    a('--host', dest='host', default='127.0.0.1',
+      help='Address to listen on. Default: %default')
+    a('--port', dest='port', type='int', default=8080,
+      help='Port to listen on. Default: %default')
+    a('--max-months', dest='max_months', type='int', default=64,
+      help='Number of parsed months to keep in memory. Default: %default')
+
+    (opts, args) = parser.parse_args()
+
+    if not os.path.isdir(opts.dir):
+        parser.error('No such directory: %s' % opts.dir)
+
+    return (opts, args)
+
+def json_default(obj):
+    """
+    Encodes dates the way AWStats writes them
+    """
+    if isinstance(obj, (AwstatsDateTime, AwstatsDate)):
+        return format_value(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def encode(obj):
+    return json.dumps(obj, default=json_default)
+
+def encode_row(row):
+    """
+    Encodes a row as a JSON object, keeping the field order
+    """
+    return '{' + ', '.join([encode(k) + ': ' + encode(v) for k, v in row.items()]) + '}'
+
+class MonthCache(object):
+    """
+    Keeps up to max_months parsed AwstatsMonth objects for the files in a
+    directory, dropping the least recently used, and any whose file's mtime
+    has changed
+    """
+    def __init__(self, directory, max_months=64):
+        self.directory = directory
+        self.max_months = max_months
+        self.__months = od()
+        self.__lock = threading.Lock()
+
+    def domains(self):
+        domains = set()
+        for fname in glob.glob(os.path.join(self.directory, 'awstats??????.*.txt*')):
+            year, month, domain = _parse_cache_name(fname)
+            if domain is not None:
+                domains.add(domain)
+        return sorted(domains)
+
+    def files(self, domain):
+        files = cache_files(self.directory, domain)
+        if not files:
+            raise KeyError("Domain '%s' does not have any records" % domain)
+        return files
+
+    def get(self, domain, year, month):
+        fname = cache_file(self.directory, domain, year, month)
+        if fname is None:
+            raise KeyError("Domain '%s' does not have any records for year %s, month %s"
+                           % (domain, year, month))
+
+        mtime = os.stat(fname).st_mtime
+        self.__lock.acquire()
+        try:
+            # Taken out and put back, so the most recently used come last
+            cached = self.__months.pop(fname, None)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, AwstatsMonth(year, month, fname))
+            self.__months[fname] = cached
+            while len(self.__months) > self.max_months:
+                del self.__months[self.__months.keys()[0]]
+        finally:
+            self.__lock.release()
+        return cached[1]
+
+    def __len__(self):
+        return len(self.__months)
+
+class AwstatsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'AwstatsServer/' + __version__
+
+    def do_GET(self):
+        # Row names (in sider, pagerefs, etc.) can contain slashes, so
+        # everything after the section is the row name
+        parts = self.path.split('?', 1)[0].lstrip('/').split('/', 4)
+        while parts and parts[-1] == '' and len(parts) < 5:
+            parts.pop()
+        parts = [urllib.unquote(p) for p in parts]
+
+        self.streaming = False
+        try:
+            self.dispatch(parts)
+        except (KeyError, ValueError), e:
+            if self.streaming:
+                # Too late to send an error response. Close the connection
+                # without ending the chunked body, so the client sees that
+                # the response is incomplete.
+                self.log_error('Error while sending %s: %s', self.path, e)
+                self.close_connection = 1
+                return
+            self.send_json(encode({'error':str(e).strip('"\'')}), code=404)
+
+    def dispatch(self, parts):
+        months = self.server.months
+
+        if len(parts) == 0:
+            return self.send_json(encode(months.domains()))
+
+        files = months.files(parts[0])
+        if len(parts) == 1:
+            return self.send_json(encode(sorted(set([y for y, m in files]))))
+
+        year = int(parts[1])
+        if len(parts) == 2:
+            month_list = sorted([m for y, m in files if y == year])
+            if not month_list:
+                raise KeyError("Domain '%s' does not have any records for year %s"
+                               % (parts[0], year))
+            return self.send_json(encode(month_list))
+
+        m = months.get(parts[0], year, int(parts[2]))
+        # Find the resource before answering If-None-Match, so missing
+        # sections and rows are still a 404
+        section = row = None
+        if len(parts) >= 4:
+            section = m[parts[3]]
+        if len(parts) == 5:
+            row = section[parts[4]]
+
+        etag = '"%s"' % '-'.join(dict(m['general'].items())['LastUpdate'])
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            return self.send_not_modified(etag)
+
+        if len(parts) == 3:
+            return self.send_json(encode(m.keys()), etag=etag)
+        if len(parts) == 4:
+            return self.send_chunked(self.stream_section(section), etag=etag)
+        return self.send_json(encode_row(row), etag=etag)
+
+    def stream_section(self, section):
+        """
+        Yields a section as a JSON object, a chunk of rows at a time
+        """
+        yield '{'
+        sep = ''
+        rows = []
+        for row_name in section:
+            rows.append(encode(row_name) + ': ' + encode_row(section[row_name]))
+            if len(rows) == ROWS_PER_CHUNK:
+                yield sep + ', '.join(rows)
+                sep = ', '
+                rows = []
+        if rows:
+            yield sep + ', '.join(rows)
+        yield '}'
+
+    def send_json(self, data, code=200, etag=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+    def send_chunked(self, chunks, etag=None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.streaming = True
+        for chunk in chunks:
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write('0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class AwstatsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server serving the cache files in a directory, a thread per
+    request
+    """
+    daemon_threads = True
+
+    def __init__(self, address, directory, verbose=False, max_months=64):
+        BaseHTTPServer.HTTPServer.__init__(self, address, AwstatsRequestHandler)
+        self.months = MonthCache(directory, max_months)
+        self.verbose = verbose
+
+def main():
+    (opts, args) = get_opts()
+
+    server = AwstatsServer((opts.host, opts.port), opts.dir, opts.verbose, opts.max_months)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()